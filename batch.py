@@ -0,0 +1,55 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from charts import EyeChart, create_chart
+from index import ChartIndex
+
+# chart object of the worker process, kept warm between jobs along with its glyph and font caches
+chart = None
+
+# index of issued charts, every worker has its own connection
+chart_index = None
+
+
+def init_worker(chart_type, background_dir=None, index_path=None):
+    global chart, chart_index
+    chart = create_chart(chart_type)
+    EyeChart.background_cache.directory = background_dir
+    if index_path:
+        chart_index = ChartIndex(index_path)
+
+
+def chart_filename(filename, index, single):
+    file, ext = os.path.splitext(filename)
+    assert ext, 'Filename should contain an extension'
+    # for 3 files option the sheet index is appended by EyeChart.save, e.g. table_00001_1.png
+    return '%s_%05d%s' % (file, index, ext) if single else '%s_%05d_%s' % (file, index, ext)
+
+
+def render_chart(index, generator_name, dpi, filename, single, mode, stream, no_repeat, seed_sequence):
+    # every chart has a random stream of its own, so its symbols do not depend on the worker drawing it
+    rng = np.random.default_rng(seed_sequence)
+    symbols = chart.sample_symbols(generator_name, 1, no_repeat, chart_index, rng=rng)[0]
+    chart.save(generator_name, dpi, chart_filename(filename, index, single), single, verbose=False, mode=mode,
+               stream=stream, symbols=symbols)
+    return index
+
+
+def render_batch(chart_type, generator_name, dpi, filename, single, count, workers=None, mode='RGB',
+                 stream=False, no_repeat=False, index_path=None, background_dir=None, seed=None):
+
+    start = time.time()
+    # the job seed spawns independent streams of the charts, so a seeded batch is reproduced whatever the number of
+    # workers and the order charts are drawn in, and without a seed the job entropy is drawn from the OS
+    seed_sequences = np.random.SeedSequence(seed).spawn(count)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(chart_type, background_dir, index_path)) as executor:
+        indices = range(1, count + 1)
+        for _ in executor.map(render_chart, indices, [generator_name]*count, [dpi]*count, [filename]*count,
+                              [single]*count, [mode]*count, [stream]*count, [no_repeat]*count, seed_sequences):
+            pass
+
+    return time.time() - start
@@ -0,0 +1,139 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from canvas import load_font
+from charts import CHART_TYPES, GENERATORS, MODES, EyeChart, create_chart
+
+# metrics compared against the baseline, the higher the worse
+METRICS = ('sheet_1_s', 'sheet_2_s', 'sheet_3_s', 'save_s', 'peak_rss_mb', 'output_bytes')
+
+
+def case_key(case):
+    return '%s/%s/%d/%s/%s%s' % (case['type'], case['generator'], case['dpi'],
+                                 'single' if case['single'] else 'three', case['mode'],
+                                 '/parallel' if case.get('parallel') else '')
+
+
+def run_case(case, repeat):
+    # every case runs in a fresh process, so that peak RSS belongs to the case alone
+    # every case draws the same charts
+    rng = np.random.default_rng(0)
+    chart = create_chart(case['type'])
+    width, height = EyeChart.sheet_size(case['dpi'])
+
+    sheet_times = [[], [], []]
+    save_times = []
+    output_bytes = 0
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'table.png')
+        for _ in range(repeat):
+            generator = chart.symbol_generator(case['generator'], rng=rng)
+            for i, method in enumerate([chart.draw_sheet_1, chart.draw_sheet_2, chart.draw_sheet_3]):
+                start = time.perf_counter()
+                method(width, height, generator, case['mode'])
+                sheet_times[i].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            chart.save(case['generator'], case['dpi'], filename, case['single'], verbose=False, mode=case['mode'],
+                       parallel=case['parallel'], rng=rng)
+            save_times.append(time.perf_counter() - start)
+
+            output_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        # allocation hooks slow down drawing, so allocations are traced in an untimed run of their own, cold as the
+        # first timed run
+        EyeChart.glyph_cache.clear()
+        EyeChart.background_cache.clear()
+        EyeChart.compile_layout.cache_clear()
+        load_font.cache_clear()
+        tracemalloc.start()
+        chart.save(case['generator'], case['dpi'], filename, case['single'], verbose=False, mode=case['mode'],
+                   parallel=case['parallel'], rng=np.random.default_rng(0))
+        _, tracemalloc_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # the first run includes glyph rasterization and font loading
+    result = dict(case)
+    result.update({'sheet_%d_s' % (i + 1): min(times) for i, times in enumerate(sheet_times)})
+    result.update({'save_s': min(save_times),
+                   'save_cold_s': save_times[0],
+                   'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   'tracemalloc_peak_mb': tracemalloc_peak / 1024 / 1024,
+                   'output_bytes': output_bytes})
+    return result
+
+
+def compare(results, baseline, tolerance):
+    baseline = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        reference = baseline.get(case_key(result))
+        if reference is None:
+            continue
+        for metric in METRICS:
+            if reference.get(metric) and result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((case_key(result), metric, reference[metric], result[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of chart rendering')
+    parser.add_argument('-t', '--types', nargs='+', default=CHART_TYPES, choices=CHART_TYPES, help='Chart types')
+    parser.add_argument('-g', '--generators', nargs='+', default=GENERATORS, choices=GENERATORS,
+                        help='Symbol generators')
+    parser.add_argument('-dpi', '--dots-per-inch', nargs='+', type=int, default=[150, 300, 600, 1200],
+                        help='Resolutions')
+    parser.add_argument('-o', '--outputs', nargs='+', default=['single', 'three'], choices=('single', 'three'),
+                        help='Single file, or 3 files output')
+    parser.add_argument('-m', '--modes', nargs='+', default=['RGB'], choices=MODES, help='Image modes')
+    parser.add_argument('-p', '--parallel', action='store_true',
+                        help='Draw and encode the sheets concurrently when saving')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per case, the fastest run is reported')
+    parser.add_argument('-f', '--filename', default='benchmark.json', help='Output JSON file with the results')
+    parser.add_argument('-b', '--baseline', help='Baseline JSON file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative increase of a metric over the baseline reported as regression')
+
+    args = parser.parse_args()
+
+    cases = [{'type': chart_type, 'generator': generator_name, 'dpi': dpi, 'single': 'single' == output, 'mode': mode,
+              'parallel': args.parallel}
+             for chart_type, generator_name, dpi, output, mode
+             in itertools.product(args.types, args.generators, args.dots_per_inch, args.outputs, args.modes)]
+
+    results = []
+    print('%-55s %8s %8s %8s %8s %9s %10s' % ('case', 'sheet 1', 'sheet 2', 'sheet 3', 'save', 'RSS, MB', 'bytes'))
+    for case in cases:
+        with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_case, (case, args.repeat))
+        results.append(result)
+        print('%-55s %8.3f %8.3f %8.3f %8.3f %9.1f %10d' % (case_key(result), result['sheet_1_s'], result['sheet_2_s'],
+                                                          result['sheet_3_s'], result['save_s'],
+                                                          result['peak_rss_mb'], result['output_bytes']))
+
+    with open(args.filename, 'w') as file:
+        json.dump({'python': sys.version, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                   'results': results}, file, indent=2)
+    print('Results saved to %s' % args.filename)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for key, metric, reference, value in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (%+.1f%%)' % (key, metric, reference, value,
+                                                               100 * (value / reference - 1)))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
@@ -0,0 +1,58 @@
+import hashlib
+import os
+import zipfile
+
+
+class OutputCache:
+
+    # encoded outputs of reproducible charts, an entry per chart description, least recently used entries are evicted
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        # the key is a tuple of strings, numbers, booleans and None, so its repr is stable
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.directory, '%s.zip' % digest)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with zipfile.ZipFile(path) as archive:
+                outputs = [archive.read(name) for name in sorted(archive.namelist(), key=int)]
+            # modification time is the time of the last use
+            os.utime(path)
+        except (FileNotFoundError, zipfile.BadZipFile):
+            return None
+        return outputs
+
+    def put(self, key, outputs):
+        path = self.path(key)
+        # written aside and renamed, so that concurrent processes never read a partially written entry
+        temporary = '%s.%d' % (path, os.getpid())
+        with zipfile.ZipFile(temporary, 'w', zipfile.ZIP_STORED) as archive:
+            for i, output in enumerate(outputs):
+                archive.writestr(str(i), output)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.zip'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
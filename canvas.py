@@ -0,0 +1,269 @@
+import math
+import os
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
+
+
+# the font is shipped along with the modules, so that charts are drawn whatever the working directory
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'arial.ttf')
+
+
+@lru_cache(maxsize=None)
+def load_font(fontsize):
+    # a font is loaded once per size and process
+    return ImageFont.truetype(FONT_PATH, fontsize)
+
+
+class RasterCanvas:
+
+    # margin around the boxes of drawn labels and lines, covers antialiased edges and glyph overhangs
+    BOX_MARGIN = 2
+
+    def __init__(self, width, height, mode='RGB', tiles=()):
+        self.width = width
+        self.height = height
+        self.image = Image.new(mode, (width, height), color='white')
+        for position, tile in tiles:
+            self.image.paste(tile, position)
+        self.draw = ImageDraw.Draw(self.image)
+        # boxes of labels and lines drawn so far, symbols are not tracked
+        self.boxes = []
+
+    def track(self, x0, y0, x1, y1):
+        margin = RasterCanvas.BOX_MARGIN
+        self.boxes.append((max(0, int(min(x0, x1)) - margin), max(0, int(min(y0, y1)) - margin),
+                           min(self.width, int(max(x0, x1)) + margin + 1),
+                           min(self.height, int(max(y0, y1)) + margin + 1)))
+
+    def tiles(self):
+        # drawn labels and lines, pasted on a white image they reproduce it exactly
+        return [(box[:2], self.image.crop(box)) for box in self.boxes]
+
+    def symbol(self, chart, x, y, size, symbol):
+        chart.paste_symbol(self.image, x, y, size, symbol)
+
+    @staticmethod
+    def text_box(x, y, text, fontsize):
+        # https://stackoverflow.com/questions/43060479/how-to-get-the-font-pixel-height-using-pil-imagefont
+        font = load_font(int(fontsize))
+        ascent, descent = font.getmetrics()
+        _, (_, offset_y) = font.font.getsize(text)
+        _, _, width, height = font.getbbox(text)
+        return font, (x, y - (ascent - offset_y) / 2, x + width, y - (ascent - offset_y) / 2 + height)
+
+    def text(self, x, y, text, fontsize):
+        font, (x0, y0, x1, y1) = RasterCanvas.text_box(x, y, text, fontsize)
+        self.draw.text((x0, y0), text, 'black', font=font)
+        self.track(x0, y0, x1, y1)
+
+    def rectangle(self, xy, fill='black'):
+        self.draw.rectangle(xy, fill=fill)
+        (x0, y0), (x1, y1) = xy
+        self.track(x0, y0, x1, y1)
+
+    def line(self, xy, fill='black'):
+        self.draw.line(xy, fill=fill)
+        (x0, y0), (x1, y1) = xy
+        self.track(x0, y0, x1, y1)
+
+    def result(self):
+        return self.image
+
+
+class TiledImage:
+
+    # image in a file on disk, drawn by pasting masks tile by tile, so that only a row of tiles is mapped to memory
+
+    # bytes per pixel, pixels of '1' images are packed 8 per byte as by Image.tobytes
+    BYTES_PER_PIXEL = {'1': 1 / 8, 'L': 1, 'RGB': 3}
+
+    def __init__(self, width, height, mode, file, tile_size=1024):
+        assert tile_size % 16 == 0, 'Tile size should be a multiple of 16'
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.file = file
+        self.tile_size = tile_size
+        self.tiles_across = -(-width // tile_size)
+        self.tiles_down = -(-height // tile_size)
+        self.tile_bytes = int(tile_size * TiledImage.BYTES_PER_PIXEL[mode])
+        # the file is sparse until the tiles are rendered
+        file.truncate(self.tiles_down * tile_size * self.tiles_across * self.tile_bytes)
+        # masks in the order they are pasted, and indices of the masks overlapping every tile
+        self.masks = []
+        self.bins = {}
+
+    def paste(self, ink, x, y, mask):
+        size = self.tile_size
+        self.masks.append((ink, x, y, mask))
+        for row in range(max(0, y // size), min(self.tiles_down, (y + mask.height - 1) // size + 1)):
+            for column in range(max(0, x // size), min(self.tiles_across, (x + mask.width - 1) // size + 1)):
+                self.bins.setdefault((row, column), []).append(len(self.masks) - 1)
+
+    def band(self, row, mode='r'):
+        # a row of tiles, every tile is tile_bytes wide
+        shape = (self.tile_size, self.tiles_across * self.tile_bytes)
+        return np.memmap(self.file, dtype=np.uint8, mode=mode, offset=row * shape[0] * shape[1], shape=shape)
+
+    def render(self):
+        size = self.tile_size
+        white = Image.new(self.mode, (size, size), color='white')
+        blank = np.frombuffer(white.tobytes(), dtype=np.uint8).reshape(size, self.tile_bytes)
+        for row in range(self.tiles_down):
+            band = self.band(row, 'r+')
+            for column in range(self.tiles_across):
+                masks = self.bins.get((row, column))
+                columns = slice(column * self.tile_bytes, (column + 1) * self.tile_bytes)
+                if masks is None:
+                    band[:, columns] = blank
+                    continue
+                # masks are clipped to the tile by the paste
+                tile = white.copy()
+                for i in masks:
+                    ink, x, y, mask = self.masks[i]
+                    tile.paste(ink, (x - column * size, y - row * size), mask)
+                band[:, columns] = np.frombuffer(tile.tobytes(), dtype=np.uint8).reshape(size, self.tile_bytes)
+            band.flush()
+            # unmapped, so that memory holds a row of tiles whatever the image size
+            del band
+
+    def tiles(self):
+        # bytes of the tiles left to right, top to bottom
+        for row in range(self.tiles_down):
+            band = self.band(row)
+            for column in range(self.tiles_across):
+                yield band[:, column * self.tile_bytes:(column + 1) * self.tile_bytes].tobytes()
+            del band
+
+
+class TiledCanvas:
+
+    def __init__(self, image, top, width, height, mode='RGB'):
+        # a sheet at the given row of a tiled image, everything drawn is a mask pasted by the image
+        assert mode == image.mode, 'Sheet mode does not match the image'
+        self.image = image
+        self.top = top
+        self.width = width
+        self.height = height
+        self.mode = mode
+
+    def paste(self, ink, x, y, mask):
+        # masks are clipped to the sheet, so that nothing is drawn on the neighbour sheets
+        box = (max(0, -x), max(0, -y), min(mask.width, self.width - x), min(mask.height, self.height - y))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        if box != (0, 0, mask.width, mask.height):
+            mask = mask.crop(box)
+        self.image.paste(ink, x + box[0], self.top + y + box[1], mask)
+
+    def symbol(self, chart, x, y, size, symbol):
+        # at the same position as by EyeChart.paste_symbol
+        mask, left, top = chart.glyph(symbol, size, x, y)
+        self.paste('black', left, top, mask)
+
+    def coverage(self, x0, y0, x1, y1, draw, fill):
+        # labels and lines are drawn on an image of their box, shifted by whole pixels they are drawn exactly as on
+        # the whole sheet, their coverage is then pasted as a mask
+        margin = RasterCanvas.BOX_MARGIN
+        left, top = int(min(x0, x1)) - margin, int(min(y0, y1)) - margin
+        image = Image.new('1' if '1' == self.mode else 'L', (int(max(x0, x1)) + margin + 1 - left,
+                                                             int(max(y0, y1)) + margin + 1 - top), color='white')
+        draw(ImageDraw.Draw(image), left, top)
+        self.paste(fill, left, top, ImageChops.invert(image))
+
+    def text(self, x, y, text, fontsize):
+        font, (x0, y0, x1, y1) = RasterCanvas.text_box(x, y, text, fontsize)
+        self.coverage(x0, y0, x1, y1,
+                      lambda draw, left, top: draw.text((x0 - left, y0 - top), text, 'black', font=font), 'black')
+
+    def rectangle(self, xy, fill='black'):
+        (x0, y0), (x1, y1) = xy
+        self.coverage(x0, y0, x1, y1, lambda draw, left, top: draw.rectangle([(x0 - left, y0 - top),
+                                                                             (x1 - left, y1 - top)], fill='black'),
+                      fill)
+
+    def line(self, xy, fill='black'):
+        (x0, y0), (x1, y1) = xy
+        self.coverage(x0, y0, x1, y1, lambda draw, left, top: draw.line([(x0 - left, y0 - top),
+                                                                        (x1 - left, y1 - top)], fill='black'),
+                      fill)
+
+    def result(self):
+        return self
+
+
+class VectorCanvas:
+
+    # text baseline below the vertical center of a label, in font sizes, half the cap height of Arial
+    BASELINE_SHIFT = 0.358
+
+    def __init__(self, width, height, mode=None):
+        self.width = width
+        self.height = height
+        # sequence of ('path', fill, commands), ('line', fill, points) and ('text', x, y, text, fontsize)
+        self.items = []
+
+    def symbol(self, chart, x, y, size, symbol):
+        # symbol renderers draw on the canvas exactly as on ImageDraw
+        chart.draw_symbol(self, x, y, size, symbol)
+
+    def text(self, x, y, text, fontsize):
+        self.items.append(('text', x, y + VectorCanvas.BASELINE_SHIFT * fontsize, text, fontsize))
+
+    @staticmethod
+    def color(fill):
+        return ImageColor.getrgb(fill) if isinstance(fill, str) else fill
+
+    @staticmethod
+    def box(xy):
+        if len(xy) == 2:
+            (x0, y0), (x1, y1) = xy
+        else:
+            x0, y0, x1, y1 = xy
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+    @staticmethod
+    def arc(box, start, end):
+        # ImageDraw angles are in degrees clockwise from 3 o'clock, as the parametric angle in y down coordinates,
+        # the arc is split into at most 90 degrees long cubic bezier curves
+        x0, y0, x1, y1 = box
+        cx, cy, rx, ry = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, (y1 - y0) / 2
+        n = max(1, int(math.ceil((end - start) / 90 - 1e-9)))
+        step = math.radians(end - start) / n
+        alpha = 4 / 3 * math.tan(step / 4)
+        t = math.radians(start)
+        commands = [('M', (cx + rx*math.cos(t), cy + ry*math.sin(t)))]
+        for _ in range(n):
+            t1 = t + step
+            commands.append(('C',
+                             (cx + rx*(math.cos(t) - alpha*math.sin(t)), cy + ry*(math.sin(t) + alpha*math.cos(t))),
+                             (cx + rx*(math.cos(t1) + alpha*math.sin(t1)), cy + ry*(math.sin(t1) - alpha*math.cos(t1))),
+                             (cx + rx*math.cos(t1), cy + ry*math.sin(t1))))
+            t = t1
+        return commands
+
+    # ImageDraw subset used by the symbol renderers, outlines only patch raster edges and are not drawn
+
+    def rectangle(self, xy, fill='black', outline=None):
+        x0, y0, x1, y1 = VectorCanvas.box(xy)
+        self.items.append(('path', VectorCanvas.color(fill),
+                           [('M', (x0, y0)), ('L', (x1, y0)), ('L', (x1, y1)), ('L', (x0, y1)), ('Z',)]))
+
+    def ellipse(self, xy, fill='black', outline=None):
+        self.chord(xy, 0, 360, fill, outline)
+
+    def chord(self, xy, start, end, fill='black', outline=None):
+        commands = VectorCanvas.arc(VectorCanvas.box(xy), start, end) + [('Z',)]
+        self.items.append(('path', VectorCanvas.color(fill), commands))
+
+    def polygon(self, xy, fill='black', outline=None):
+        commands = [('M', xy[0])] + [('L', point) for point in xy[1:]] + [('Z',)]
+        self.items.append(('path', VectorCanvas.color(fill), commands))
+
+    def line(self, xy, fill='black'):
+        self.items.append(('line', VectorCanvas.color(fill), list(xy)))
+
+    def result(self):
+        return self
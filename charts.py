@@ -1,9 +1,76 @@
+import io
+import math
 import numpy as np
 import os
-from PIL import Image, ImageDraw, ImageFont
+import tempfile
+import threading
+from PIL import Image, ImageChops, ImageDraw
 from abc import abstractmethod
-
-from generator import RandomGenerator, SequenceGenerator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from canvas import RasterCanvas, TiledCanvas, TiledImage, VectorCanvas
+from generator import BatchSampler, RandomGenerator, SequenceGenerator
+from profiling import NullProfiler
+from writers import TiledTiffWriter, open_strip_writer, write_pdf, write_svg
+
+
+class GlyphCache:
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.rasters = OrderedDict()
+        # sheets may be drawn by concurrent threads, a missing raster may be rendered twice, but is stored once
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        with self.lock:
+            raster = self.rasters.get(key)
+            if raster is not None:
+                self.rasters.move_to_end(key)
+                return raster
+        raster = render()
+        with self.lock:
+            self.rasters[key] = raster
+            if len(self.rasters) > self.maxsize:
+                self.rasters.popitem(last=False)
+        return raster
+
+    def clear(self):
+        with self.lock:
+            self.rasters.clear()
+
+
+class BackgroundCache(GlyphCache):
+
+    # static parts of the sheets, labels and rules, kept as the tiles of the drawn pixels, optionally also on disk
+
+    def __init__(self, maxsize=64, directory=None):
+        super().__init__(maxsize)
+        self.directory = directory
+
+    def get(self, key, render):
+        if self.directory is None:
+            return super().get(key, render)
+        return super().get(key, lambda: self.load(key, render))
+
+    def load(self, key, render):
+        filename = os.path.join(self.directory, 'background_%s_%d_%dx%d_%s_%gx%gmm.npz' % key)
+        if os.path.exists(filename):
+            with np.load(filename) as data:
+                return [(tuple(position), Image.fromarray(data['tile_%d' % i]))
+                        for i, position in enumerate(data['positions'])]
+
+        tiles = render()
+        EyeChart.make_dirs(filename)
+        # written aside and renamed, so that concurrent workers never load a partially written file
+        temporary = '%s.%d' % (filename, os.getpid())
+        with open(temporary, 'wb') as file:
+            np.savez(file, positions=np.array([position for position, _ in tiles], dtype=np.int64).reshape(-1, 2),
+                     **{'tile_%d' % i: np.asarray(tile) for i, (_, tile) in enumerate(tiles)})
+        os.replace(temporary, filename)
+        return tiles
 
 
 class EyeChart:
@@ -14,6 +81,24 @@ class EyeChart:
     TABLE_WIDTH = 173
     V_OFFSET_MM_RIGHT = 40
     D_OFFSET_MM_LEFT = 30
+    FONT_SIZE_MM = 4.2
+    # part of the keys of cached charts, increased whenever the same chart is drawn differently
+    DRAWING_VERSION = 3
+
+    # every sheet is (lines, rules), a line is (offset from the previous line, visual acuity), a rule is
+    # ('rectangle' or 'line', x0, y0, x1, y1), all in mm, lines are given numbers of symbols by line_lengths in order
+    LAYOUT = ((((20, 0.1), (23, 0.2), (23, 0.3)),
+               ()),
+              (((14, 0.4), (23, 0.5), (23, 0.6), (23, 0.7), (23, 0.8), (23, 0.9)),
+               ()),
+              (((13, 1.0), (23, 1.5), (23, 2.0), (36, 3.0), (23, 4.0), (23, 5.0)),
+               (('rectangle', 1, 28, A4_WIDTH_MM - 6, 28.7),
+                ('line', 1, 98, A4_WIDTH_MM - 6, 98))))
+
+    # a raster per symbol and position of the layout, about 2000 of them for all chart types at a resolution
+    glyph_cache = GlyphCache(4096)
+    background_cache = BackgroundCache()
+    profiler = NullProfiler()
     
     @abstractmethod
     def symbol_renderers(self):
@@ -27,8 +112,67 @@ class EyeChart:
     def line_lengths(self):
         pass
     
+    def glyph_sources(self):
+        # (base symbol, transpose) pairs, symbols sharing a base are rasterized once and transposed, for screens only,
+        # since transposed rasters of the printed charts would differ from the symbols drawn by their renderers
+        return [(symbol, None) for symbol in range(len(self.symbol_renderers()))]
+
+    def glyph_key(self, symbol, size):
+        return type(self).__name__, getattr(self, 'k_alt', False), symbol, size
+
     def draw_symbol(self, draw, x, y, size, symbol):
         self.symbol_renderers()[symbol](draw, x, y, size)
+
+    def glyph_overhang(self, size):
+        # how far above and left of the margin the renderers draw, like the ellipses K is cut from
+        return 0
+
+    def rasterize_symbol(self, symbol, size, x, y):
+        # glyph box of the symbol drawn at (x, y) of a raster, the margin covers strokes drawn outside of the symbol
+        # box, like the arms of K
+        name = self.symbol_renderers()[symbol].__name__
+        with EyeChart.profiler.phase('rasterize/%s' % name):
+            margin = int(size / 5) + 2
+            side = 2*margin + int(size) + 1
+            left, top = math.floor(x) - margin, math.floor(y) - margin
+            raster = Image.new('L', (left + side, top + side), color='white')
+            self.draw_symbol(EyeChart.profiler.draw(ImageDraw.Draw(raster), name), x, y, size, symbol)
+            # inverted before cropping, so that the box beyond the raster has no ink
+            return ImageChops.invert(raster).crop((left, top, left + side, top + side)).convert('1', dither=Image.NONE)
+
+    def glyph(self, symbol, size, x, y):
+        # mask of the symbol drawn at (x, y) of the sheet and the sheet position of the mask, masks are kept per
+        # sub-pixel phase of the position, positions are defined by the layout, so there are a few phases per line
+        left, top = math.floor(x), math.floor(y)
+        margin = int(size / 5) + 2
+        # drawing truncates coordinates towards zero, rasters keep the signs of the sheet coordinates, so that they
+        # are truncated alike and the mask has the same pixels as the symbol drawn on the sheet
+        origin = min(left, margin + self.glyph_overhang(size)), min(top, margin + self.glyph_overhang(size))
+        phase = x - left + origin[0], y - top + origin[1]
+        mask = EyeChart.glyph_cache.get(self.glyph_key(symbol, size) + phase,
+                                        lambda: self.rasterize_symbol(symbol, size, *phase))
+        return mask, left - margin, top - margin
+
+    def antialiased_glyph(self, symbol, size, supersampling=4):
+        # grayscale coverage of the symbol for screens, drawn supersampled and averaged down
+        base, transpose = self.glyph_sources()[symbol]
+
+        def render():
+            if transpose is not None:
+                mask, margin = self.antialiased_glyph(base, size, supersampling)
+                return mask.transpose(transpose), margin
+            margin = int(size / 5) + 2
+            side = 2*margin + int(size) + 1
+            raster = Image.new('L', (side * supersampling, side * supersampling), color='white')
+            self.draw_symbol(ImageDraw.Draw(raster), margin * supersampling, margin * supersampling,
+                             size * supersampling, symbol)
+            return ImageChops.invert(raster).resize((side, side), Image.BOX), margin
+
+        return EyeChart.glyph_cache.get(self.glyph_key(symbol, size) + ('antialiased', supersampling), render)
+
+    def paste_symbol(self, image, x, y, size, symbol):
+        mask, left, top = self.glyph(symbol, size, x, y)
+        image.paste('black', (left, top), mask)
     
     @staticmethod
     def x_positions(n, width, height, v):
@@ -39,114 +183,430 @@ class EyeChart:
                  (size + space)*k) / EyeChart.A4_WIDTH_MM * width
                 for k in range(n)], size / EyeChart.A4_HEIGHT_MM * height
 
-    def symbol_generator(self, generator_name):
+    def symbol_sampler(self, rng=None):
+        return BatchSampler(len(self.symbol_renderers()), self.standard_symbols(), self.line_lengths(), rng=rng)
 
-        if 'standard' == generator_name:
+    def fingerprint(self, symbols):
+        # the altered K does not make a chart different for a patient, so only the chart class is hashed, the index
+        # module is imported only by the runs fingerprinting charts, since it imports sqlite3
+        from index import chart_fingerprint
+        return chart_fingerprint(type(self).__name__, symbols)
+
+    def sample_symbols(self, generator_name, n_charts, no_repeat=False, index=None, max_attempts=100, rng=None):
+
+        with EyeChart.profiler.phase('sample'):
+            sampler = self.symbol_sampler(rng)
+            symbols = sampler.sample(generator_name, n_charts, no_repeat)
+            if index is None:
+                return symbols
+
+            # charts are claimed in the index before anything is drawn, charts issued before are resampled
+            pending = np.arange(n_charts)
+            for _ in range(max_attempts):
+                claimed = index.claim_many([self.fingerprint(row) for row in symbols[pending]])
+                pending = pending[~np.array(claimed, dtype=bool)]
+                if not len(pending):
+                    return symbols
+                symbols[pending] = sampler.sample(generator_name, len(pending), no_repeat)
+
+        raise ValueError('Failed to sample %d charts not issued before with %s generator' % (len(pending),
+                                                                                         generator_name))
+
+    def symbol_generator(self, generator_name, symbols=None, rng=None):
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        if symbols is not None:
+            # a row sampled by BatchSampler
+            return SequenceGenerator(sequence=list(symbols))
+        elif 'standard' == generator_name:
             return SequenceGenerator(sequence=self.standard_symbols())
         elif 'shifted' == generator_name:
-            global_shift = np.random.randint(0, len(self.standard_symbols()), 1)[0]
+            global_shift = rng.integers(0, len(self.standard_symbols()))
             return SequenceGenerator(sequence=self.standard_symbols(), global_shift=global_shift)
         elif 'global_shuffle' == generator_name:
-            return SequenceGenerator(sequence=self.standard_symbols(), shuffle='global')
+            return SequenceGenerator(sequence=self.standard_symbols(), shuffle='global', rng=rng)
         elif 'line_shuffle' == generator_name:
-            return SequenceGenerator(sequence=self.standard_symbols(), shuffle='line')
+            return SequenceGenerator(sequence=self.standard_symbols(), shuffle='line', rng=rng)
         elif 'shifted_line_shuffle' == generator_name:
-            global_shift = np.random.randint(0, len(self.standard_symbols()), 1)[0]
-            return SequenceGenerator(sequence=self.standard_symbols(), global_shift=global_shift, shuffle='line')
+            global_shift = rng.integers(0, len(self.standard_symbols()))
+            return SequenceGenerator(sequence=self.standard_symbols(), global_shift=global_shift, shuffle='line',
+                                     rng=rng)
         elif 'random' == generator_name:
-            return RandomGenerator(n_symbols=len(self.symbol_renderers()))
+            return RandomGenerator(n_symbols=len(self.symbol_renderers()), rng=rng)
         elif 'smart_random' == generator_name:
-            return RandomGenerator(n_symbols=len(self.symbol_renderers()), smart=True)
+            return RandomGenerator(n_symbols=len(self.symbol_renderers()), smart=True, rng=rng)
         else:
             raise NotImplementedError(generator_name)
     
-    def draw_sheet(self, width, height, offsets, ns, vs, generator):
-    
-        image = Image.new('RGB', (width, height), color='white')
-        draw = ImageDraw.Draw(image)
+    def layout(self):
+        return self.LAYOUT
 
-        fontsize = int(4.2 / EyeChart.A4_HEIGHT_MM * height)
+    def sheet_lengths(self):
+        # numbers of symbols of the lines of every sheet, lines beyond line_lengths are not drawn
+        lengths = iter(self.line_lengths())
+        return tuple(tuple(n for _, n in zip(lines, lengths)) for lines, _ in self.layout())
 
-        # https://stackoverflow.com/questions/43060479/how-to-get-the-font-pixel-height-using-pil-imagefont
-        font = ImageFont.truetype(os.path.join('fonts', 'arial.ttf'), fontsize)
-        ascent, descent = font.getmetrics()
-
-        y = 0
-        for offset, n, v in zip(offsets, ns, vs):    
-            y += offset / EyeChart.A4_HEIGHT_MM * height
-            xs, size = EyeChart.x_positions(n, width, height, v)
-            symbols = generator.next_symbols(n)
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def compile_layout(layout, sheet_lengths, width, height, page_size):
+        # the layout converted to the canvas units once, drawing a sheet is then only a pass over the tables
+
+        # the A4 layout is scaled uniformly to fit the page and centred on it, symbols scaled up are read from
+        # distances as many times longer
+        page_width, page_height = page_size
+        scale = min(page_width / EyeChart.A4_WIDTH_MM, page_height / EyeChart.A4_HEIGHT_MM)
+        left = (page_width - EyeChart.A4_WIDTH_MM * scale) / 2 / page_width * width
+        top = (page_height - EyeChart.A4_HEIGHT_MM * scale) / 2 / page_height * height
+        # the canvas units taken by the layout
+        width = EyeChart.A4_WIDTH_MM * scale / page_width * width
+        height = EyeChart.A4_HEIGHT_MM * scale / page_height * height
+
+        fontsize = EyeChart.FONT_SIZE_MM / EyeChart.A4_HEIGHT_MM * height
+
+        tables = []
+        for (lines, rules), lengths in zip(layout, sheet_lengths):
+            table = {'lines': [], 'labels': [], 'fontsize': fontsize, 'rules': []}
+            y = top
+            for (offset, v), n in zip(lines, lengths):
+                y += offset / EyeChart.A4_HEIGHT_MM * height
+                xs, size = EyeChart.x_positions(n, width, height, v)
+                xs = [left + x for x in xs]
+                table['lines'].append((y, xs, size))
+                if n:
+                    d_text = ('D = %.1f' % (5.0 * scale / v)).replace('.', ',')
+                    v_text = ('V = %.1f' % v).replace('.', ',')
+                    table['labels'].append((left + EyeChart.D_OFFSET_MM_LEFT / EyeChart.A4_WIDTH_MM * width,
+                                            y + size / 2, d_text))
+                    table['labels'].append((left + (EyeChart.A4_WIDTH_MM - EyeChart.V_OFFSET_MM_RIGHT) /
+                                            EyeChart.A4_WIDTH_MM * width, y + size / 2, v_text))
+                y += size
+            for kind, x0, y0, x1, y1 in rules:
+                table['rules'].append((kind, ((left + x0 / EyeChart.A4_WIDTH_MM * width,
+                                               top + y0 / EyeChart.A4_HEIGHT_MM * height),
+                                              (left + x1 / EyeChart.A4_WIDTH_MM * width,
+                                               top + y1 / EyeChart.A4_HEIGHT_MM * height))))
+            tables.append(table)
+
+        return tables
+
+    def sheet_table(self, sheet, width, height, page_size=None):
+        return EyeChart.compile_layout(self.layout(), self.sheet_lengths(), width, height,
+                                       tuple(EyeChart.page_size(page_size)))[sheet - 1]
+
+    def draw_background(self, canvas, sheet, page_size=None):
+        table = self.sheet_table(sheet, canvas.width, canvas.height, page_size)
+        for x, y, text in table['labels']:
+            canvas.text(x, y, text, table['fontsize'])
+        for kind, xy in table['rules']:
+            getattr(canvas, kind)(xy)
+        return canvas
+
+    def draw_symbols(self, canvas, sheet, generator, page_size=None):
+        names = ['glyph/%s' % renderer.__name__ for renderer in self.symbol_renderers()]
+        for y, xs, size in self.sheet_table(sheet, canvas.width, canvas.height, page_size)['lines']:
+            with EyeChart.profiler.phase('sample'):
+                symbols = generator.next_symbols(len(xs))
             for x, symbol in zip(xs, symbols):
-                self.draw_symbol(draw, x, y, size, symbol)
+                with EyeChart.profiler.phase(names[symbol]):
+                    canvas.symbol(self, x, y, size, symbol)
+        return canvas
+
+    def draw_sheet(self, sheet, width, height, generator, mode='RGB', backend=RasterCanvas, page_size=None):
+        if backend is RasterCanvas:
+            # the background does not depend on the symbols, it is drawn once and then pasted under them
+            key = (type(self).__name__, sheet, width, height, mode) + tuple(EyeChart.page_size(page_size))
+            tiles = EyeChart.background_cache.get(key, lambda: self.background_tiles(sheet, width, height, mode,
+                                                                                     page_size))
+            with EyeChart.profiler.phase('background'):
+                canvas = RasterCanvas(width, height, mode, tiles)
+        else:
+            # vector sheets are drawn once per file, the background is not worth caching
+            with EyeChart.profiler.phase('labels'):
+                canvas = self.draw_background(backend(width, height, mode), sheet, page_size)
+        result = self.draw_symbols(canvas, sheet, generator, page_size).result()
+        EyeChart.profiler.memory('sheet %d' % sheet)
+        return result
 
-            if symbols:
-                d_text = ('D = %.1f' % (5.0 / v)).replace('.', ',')
-                v_text = ('V = %.1f' % v).replace('.', ',')
-                _, (_, d_offset_y) = font.font.getsize(d_text)
-                _, (_, v_offset_y) = font.font.getsize(v_text)
-                draw.text((EyeChart.D_OFFSET_MM_LEFT / EyeChart.A4_WIDTH_MM * width,
-                           y + size / 2 - (ascent - d_offset_y) / 2), d_text, (0, 0, 0), font=font)
-                draw.text(((EyeChart.A4_WIDTH_MM - EyeChart.V_OFFSET_MM_RIGHT) / EyeChart.A4_WIDTH_MM * width,
-                           y + size / 2 - (ascent - v_offset_y) / 2), v_text, (0, 0, 0), font=font)
+    def background_tiles(self, sheet, width, height, mode, page_size=None):
+        with EyeChart.profiler.phase('labels'):
+            return self.draw_background(RasterCanvas(width, height, mode), sheet, page_size).tiles()
 
-            y += size
+    def draw_sheet_1(self, width, height, generator, mode='RGB', backend=RasterCanvas, page_size=None):
+        return self.draw_sheet(1, width, height, generator, mode, backend, page_size)
 
-        return image
-    
-    def draw_sheet_1(self, width, height, generator):
-        return self.draw_sheet(width, height, [20, 23, 23], 
-                               self.line_lengths()[:3], [0.1, 0.2, 0.3], generator)
-
-    def draw_sheet_2(self, width, height, generator):
-        return self.draw_sheet(width, height, [14, 23, 23, 23, 23, 23], 
-                               self.line_lengths()[3:9], [0.4, 0.5, 0.6, 0.7, 0.8, 0.9], generator)
-
-    def draw_sheet_3(self, width, height, generator):
-        lengths = self.line_lengths()[9:]
-        image = self.draw_sheet(width, height, [13, 23, 23, 36, 23, 23][:len(lengths)],
-                                lengths, [1.0, 1.5, 2.0, 3.0, 4.0, 5.0][:len(lengths)], generator)
-    
-        draw = ImageDraw.Draw(image)
-        draw.rectangle(((1./EyeChart.A4_WIDTH_MM * width, 28./EyeChart.A4_HEIGHT_MM * height),
-                        ((EyeChart.A4_WIDTH_MM - 6.)/EyeChart.A4_WIDTH_MM*width, 28.7/EyeChart.A4_HEIGHT_MM * height)),
-                       fill='black')
-        draw.line(((1./EyeChart.A4_WIDTH_MM * width, 98./EyeChart.A4_HEIGHT_MM * height),
-                   ((EyeChart.A4_WIDTH_MM - 6.)/EyeChart.A4_WIDTH_MM * width, 98./EyeChart.A4_HEIGHT_MM * height)),
-                  fill='black')
-
-        return image
+    def draw_sheet_2(self, width, height, generator, mode='RGB', backend=RasterCanvas, page_size=None):
+        return self.draw_sheet(2, width, height, generator, mode, backend, page_size)
+
+    def draw_sheet_3(self, width, height, generator, mode='RGB', backend=RasterCanvas, page_size=None):
+        return self.draw_sheet(3, width, height, generator, mode, backend, page_size)
     
     @staticmethod
-    def save_image(image, filename):
+    def make_dirs(filename):
         head, tail = os.path.split(filename)
         if head:
-            if not os.path.exists(head):
-                os.makedirs(head)
-        image.save(filename)
+            # concurrent threads and batch workers may create the same directory
+            os.makedirs(head, exist_ok=True)
+
+    @staticmethod
+    def save_image(image, filename):
+        EyeChart.make_dirs(filename)
+        with EyeChart.profiler.phase('encode'):
+            image.save(filename)
     
-    def save(self, generator_name, dpi=600, filename='sheet.png', single=False):
+    @staticmethod
+    def page_size(page_size=None):
+        # the layout is drawn scaled to the page, A4 by default
+        return page_size or (EyeChart.A4_WIDTH_MM, EyeChart.A4_HEIGHT_MM)
 
-        generator = self.symbol_generator(generator_name)
+    @staticmethod
+    def sheet_size(dpi, page_size=None):
+        width_mm, height_mm = EyeChart.page_size(page_size)
+        return (int(width_mm * dpi / EyeChart.MM_PER_INCH),
+                int(height_mm * dpi / EyeChart.MM_PER_INCH))
+
+    def sheets(self, generator, width, height, mode='RGB', backend=RasterCanvas, page_size=None):
+        # sheets are drawn lazily, one at a time, since they consume the generator in order
+        for method in [self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3]:
+            yield method(width, height, generator, mode, backend, page_size)
+
+    def sheet_generators(self, generator):
+        # symbols of all lines are drawn up front, in the order the sheets drawn one by one would draw them,
+        # so that sheets can be drawn in any order with exactly the same symbols
+        with EyeChart.profiler.phase('sample'):
+            lines = [list(generator.next_symbols(n)) for n in self.line_lengths()]
+        generators = []
+        start = 0
+        for lengths in self.sheet_lengths():
+            end = start + len(lengths)
+            generators.append(SequenceGenerator(sequence=[symbol for line in lines[start:end] for symbol in line]))
+            start = end
+        return generators
+
+    def parallel_sheets(self, generator, width, height, mode='RGB', page_size=None):
+        # sheets are drawn concurrently and yielded in order, the first one may be encoded while others are drawn
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(method, width, height, sheet_generator, mode, RasterCanvas, page_size)
+                       for method, sheet_generator in zip([self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3],
+                                                          self.sheet_generators(generator))]
+            for future in futures:
+                yield future.result()
+
+    def save_sheet(self, method, width, height, generator, mode, filename, page_size=None):
+        EyeChart.save_image(method(width, height, generator, mode, RasterCanvas, page_size), filename)
+
+    def vector_sheets(self, generator, page_size=None):
+        # vector sheets are drawn in millimetres, independently of the resolution
+        width, height = EyeChart.page_size(page_size)
+        return list(self.sheets(generator, width, height, backend=VectorCanvas, page_size=page_size))
+
+    def render(self, generator_name, dpi=600, single=False, mode='RGB', symbols=None, rng=None):
+
+        generator = self.symbol_generator(generator_name, symbols, rng)
+        width, height = EyeChart.sheet_size(dpi)
+
+        if not single:
+            return list(self.sheets(generator, width, height, mode))
+
+        result = Image.new(mode, (width, 3*height))
+        for i, image in enumerate(self.sheets(generator, width, height, mode)):
+            with EyeChart.profiler.phase('compose'):
+                result.paste(im=image, box=(0, i*height))
+        return [result]
+
+    def render_bytes(self, generator_name, dpi=600, single=False, mode='RGB', format='PNG', symbols=None, rng=None):
+
+        format = format.upper()
+        if 'PDF' == format:
+            sheets = self.vector_sheets(self.symbol_generator(generator_name, symbols, rng))
+            buffer = io.BytesIO()
+            with EyeChart.profiler.phase('encode'):
+                write_pdf(buffer, [sheets] if single else [[sheet] for sheet in sheets])
+            return [buffer.getvalue()]
+        elif 'SVG' == format:
+            sheets = self.vector_sheets(self.symbol_generator(generator_name, symbols, rng))
+            buffers = []
+            for group in [sheets] if single else [[sheet] for sheet in sheets]:
+                buffers.append(io.BytesIO())
+                with EyeChart.profiler.phase('encode'):
+                    write_svg(buffers[-1], group)
+            return [buffer.getvalue() for buffer in buffers]
+
+        result = []
+        for image in self.render(generator_name, dpi, single, mode, symbols, rng):
+            buffer = io.BytesIO()
+            with EyeChart.profiler.phase('encode'):
+                image.save(buffer, format=format)
+            result.append(buffer.getvalue())
+        return result
+
+    def save_vector(self, generator, filename, single=False, verbose=True, page_size=None):
+
+        sheets = self.vector_sheets(generator, page_size)
+
+        ext = os.path.splitext(filename)[1]
+        EyeChart.make_dirs(filename)
+        with EyeChart.profiler.phase('encode'):
+            if '.pdf' == ext.lower():
+                # a single page with all sheets, or a page per sheet to be printed on A4
+                with open(filename, 'wb') as output:
+                    write_pdf(output, [sheets] if single else [[sheet] for sheet in sheets])
+                image_names = [filename]
+            elif single:
+                with open(filename, 'wb') as output:
+                    write_svg(output, sheets)
+                image_names = [filename]
+            else:
+                image_names = EyeChart.output_names(filename, single)
+                for sheet, image_name in zip(sheets, image_names):
+                    with open(image_name, 'wb') as output:
+                        write_svg(output, [sheet])
+
+        if verbose:
+            for image_name in image_names:
+                print('File %s saved' % image_name)
+
+    @staticmethod
+    def output_names(filename, single):
+        file, ext = os.path.splitext(filename)
+        if single or '.pdf' == ext.lower():
+            return [filename]
+        return ['%s%d%s' % (file, i + 1, ext) for i in range(3)]
+
+    def cache_key(self, generator_name, seed, dpi, filename, single, mode, stream, page_size=None, tile_size=None):
+        ext = os.path.splitext(filename)[1].lower()
+        if 'standard' == generator_name:
+            # standard charts are the same whatever the seed
+            seed = None
+        if ext in ('.svg', '.pdf'):
+            # vector output does not depend on the resolution and image mode
+            dpi, mode = None, None
+        # streamed files are encoded by the strip writers, byte by byte they differ from the files saved by Pillow,
+        # seeds are expanded into PCG64 streams, charts cached with the legacy global RandomState are not matched,
+        # charts cached before a change of drawing are not matched either
+        return (type(self).__name__, getattr(self, 'k_alt', False), generator_name, 'PCG64', EyeChart.DRAWING_VERSION,
+                seed, dpi, mode, single, single and stream and not tile_size, ext, tuple(EyeChart.page_size(page_size)),
+                tile_size)
+
+    def save(self, generator_name, dpi=600, filename='sheet.png', single=False, verbose=True, mode='RGB',
+             stream=False, symbols=None, parallel=False, seed=None, cache=None, rng=None, page_size=None,
+             tile_size=None):
+
+        key = None
+        # a chart is reproducible when its symbols are defined by the generator and the seed alone
+        if cache is not None and symbols is None and (seed is not None or 'standard' == generator_name):
+            key = self.cache_key(generator_name, seed, dpi, filename, single, mode, stream, page_size, tile_size)
+            with EyeChart.profiler.phase('cache'):
+                outputs = cache.get(key)
+            image_names = EyeChart.output_names(filename, single)
+            if outputs is not None and len(outputs) == len(image_names):
+                for output, image_name in zip(outputs, image_names):
+                    EyeChart.make_dirs(image_name)
+                    with open(image_name, 'wb') as file:
+                        file.write(output)
+                    if verbose:
+                        print('File %s saved from cache' % image_name)
+                return
+
+        if rng is None:
+            # a random state of the chart alone, so that concurrent charts do not depend on each other
+            rng = np.random.default_rng(seed)
+        self.save_chart(generator_name, dpi, filename, single, verbose, mode, stream, symbols, parallel, rng,
+                        page_size, tile_size)
+
+        if key is not None:
+            outputs = []
+            for image_name in EyeChart.output_names(filename, single):
+                with open(image_name, 'rb') as file:
+                    outputs.append(file.read())
+            with EyeChart.profiler.phase('cache'):
+                cache.put(key, outputs)
+
+    def save_tiled(self, generator, width, height, filename, single, verbose=True, mode='RGB', tile_size=1024,
+                   page_size=None):
+
+        if os.path.splitext(filename)[1].lower() not in ('.tif', '.tiff'):
+            raise ValueError('Tiled charts are saved to TIFF files only')
+
+        # sheets are drawn into tiles of an image on disk next to the output, instead of an image in memory, so that
+        # the size of wall charts is limited by the disk, all sheets of a single file are tiles of the same image
+        methods = [self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3]
+        groups = [methods] if single else [[method] for method in methods]
+        for group, image_name in zip(groups, EyeChart.output_names(filename, single)):
+            EyeChart.make_dirs(image_name)
+            with tempfile.TemporaryFile(dir=os.path.dirname(image_name) or '.') as file:
+                image = TiledImage(width, len(group) * height, mode, file, tile_size)
+                for i, method in enumerate(group):
+                    method(width, height, generator, mode, partial(TiledCanvas, image, i * height), page_size)
+                with EyeChart.profiler.phase('compose'):
+                    image.render()
+                with EyeChart.profiler.phase('encode'), open(image_name, 'wb') as output:
+                    writer = TiledTiffWriter(output, image.width, image.height, mode, tile_size)
+                    for tile in image.tiles():
+                        writer.write_tile(tile)
+                    writer.close()
+            if verbose:
+                print('File %s saved' % image_name)
 
-        width = int(EyeChart.A4_WIDTH_MM * dpi / EyeChart.MM_PER_INCH)
-        height = int(EyeChart.A4_HEIGHT_MM * dpi / EyeChart.MM_PER_INCH)
+    def save_chart(self, generator_name, dpi, filename, single, verbose, mode, stream, symbols, parallel, rng,
+                   page_size=None, tile_size=None):
+
+        with EyeChart.profiler.phase('sample'):
+            generator = self.symbol_generator(generator_name, symbols, rng)
+
+        if os.path.splitext(filename)[1].lower() in ('.svg', '.pdf'):
+            self.save_vector(generator, filename, single, verbose, page_size)
+            return
+
+        width, height = EyeChart.sheet_size(dpi, page_size)
+        if tile_size:
+            self.save_tiled(generator, width, height, filename, single, verbose, mode, tile_size, page_size)
+            return
+        sheets = self.parallel_sheets if parallel else self.sheets
         
-        if single:
-            result = Image.new('RGB', (width, 3*height))
-            for i, method in enumerate([self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3]):
-                image = method(width, height, generator)
-                result.paste(im=image, box=(0, i*height))
+        if single and stream:
+            # sheets are encoded as soon as they are rendered, so only one sheet is kept in memory unless parallel
+            EyeChart.make_dirs(filename)
+            with open_strip_writer(filename, width, 3*height, mode) as writer:
+                for image in sheets(generator, width, height, mode, page_size=page_size):
+                    with EyeChart.profiler.phase('encode'):
+                        writer.write(image)
+                # the data still buffered by the compressor is flushed on close
+                with EyeChart.profiler.phase('encode'):
+                    writer.close()
+            if verbose:
+                print('File %s saved' % filename)
+        elif single:
+            result = Image.new(mode, (width, 3*height))
+            for i, image in enumerate(sheets(generator, width, height, mode, page_size=page_size)):
+                with EyeChart.profiler.phase('compose'):
+                    result.paste(im=image, box=(0, i*height))
             EyeChart.save_image(result, filename)
-            print('File %s saved' % filename)
+            if verbose:
+                print('File %s saved' % filename)
         else:        
-            file, ext = os.path.splitext(filename)
-            assert ext, 'Filename should contain an extension'
-            
-            for i, method in enumerate([self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3]):
-                image = method(width, height, generator)
-                image_name = '%s%d%s' % (file, i + 1, ext)
-                EyeChart.save_image(image, image_name)
-                print('File %s saved' % image_name)
+            assert os.path.splitext(filename)[1], 'Filename should contain an extension'
+            image_names = EyeChart.output_names(filename, single)
+
+            if parallel:
+                # every sheet is drawn and encoded by a thread of its own, encoders release the GIL
+                with ThreadPoolExecutor(max_workers=3) as executor:
+                    futures = [executor.submit(self.save_sheet, method, width, height, sheet_generator, mode,
+                                               image_name, page_size)
+                               for method, sheet_generator, image_name
+                               in zip([self.draw_sheet_1, self.draw_sheet_2, self.draw_sheet_3],
+                                      self.sheet_generators(generator), image_names)]
+                    for future, image_name in zip(futures, image_names):
+                        future.result()
+                        if verbose:
+                            print('File %s saved' % image_name)
+            else:
+                for image, image_name in zip(self.sheets(generator, width, height, mode, page_size=page_size),
+                                             image_names):
+                    EyeChart.save_image(image, image_name)
+                    if verbose:
+                        print('File %s saved' % image_name)
 
 
 class GolovinSivtsev(EyeChart):
@@ -154,24 +614,28 @@ class GolovinSivtsev(EyeChart):
     def __init__(self, k_alt=False):
         self.k_alt = k_alt
 
+    def glyph_overhang(self, size):
+        # the bowls of K are cut from ellipses reaching 3/5 of the size above the symbol
+        return int(size / 2)
+
     @staticmethod
     def draw_sh(draw, x, y, size):
         width = size / 5
-        draw.rectangle(((x, y + size), (x + size, y + size - width)), fill='black')
-        draw.rectangle(((x, y + size - width), (x + width, y)), fill='black')
-        draw.rectangle(((x + 2*width, y + size - width), (x + 3*width, y)), fill='black')
-        draw.rectangle(((x + 4*width, y + size - width), (x + size, y)), fill='black')
+        draw.rectangle(((x, y + size - width), (x + size, y + size)), fill='black')
+        draw.rectangle(((x, y), (x + width, y + size - width)), fill='black')
+        draw.rectangle(((x + 2*width, y), (x + 3*width, y + size - width)), fill='black')
+        draw.rectangle(((x + 4*width, y), (x + size, y + size - width)), fill='black')
     
     @staticmethod
     def draw_b(draw, x, y, size):
         width = size / 5
-        draw.rectangle(((x, y + size), (x + width, y)), fill='black')
-        draw.rectangle(((x, y + width), (x + size, y)), fill='black')
+        draw.rectangle(((x, y), (x + width, y + size)), fill='black')
+        draw.rectangle(((x, y), (x + size, y + width)), fill='black')
         draw.ellipse((x + 2*width, y + 2*width, x + size, y + size), fill='black', outline='black')
         draw.ellipse((x + 3*width, y + 3*width, x + 4*width, y + 4*width), fill = 'white', outline='black')
-        draw.rectangle(((x + width, y + 4*width), (x + 3.5*width, y + 3*width)), fill='white', outline='white')
-        draw.rectangle(((x + width, y + 3*width), (x + 3.5*width, y + 2*width)), fill='black')
-        draw.rectangle(((x + width, y + 5*width), (x + 3.5*width, y + 4*width)), fill='black')
+        draw.rectangle(((x + width, y + 3*width), (x + 3.5*width, y + 4*width)), fill='white', outline='white')
+        draw.rectangle(((x + width, y + 2*width), (x + 3.5*width, y + 3*width)), fill='black')
+        draw.rectangle(((x + width, y + 4*width), (x + 3.5*width, y + 5*width)), fill='black')
         
     @staticmethod
     def draw_m(draw, x, y, size):
@@ -301,6 +765,9 @@ class LandoltC(EyeChart):
         draw.ellipse((x + width, y + width, x + 4*width, y + 4*width), fill='white', outline='white')
         draw.rectangle(((x, y + 2*width), (x + 2*width, y + 3*width)), fill='white', outline='white')
 
+    def glyph_sources(self):
+        return [(0, None), (0, Image.ROTATE_270), (0, Image.ROTATE_180), (0, Image.ROTATE_90)]
+
     def symbol_renderers(self):
         return [LandoltC.draw_circle_up,
                 LandoltC.draw_circle_right,
@@ -359,10 +826,13 @@ class EChart(EyeChart):
     @staticmethod
     def draw_e_turn_ccw(draw, x, y, size):
         width = size / 5
-        draw.rectangle(((x, y + size), (x + size, y + size - width)), fill='black')
-        draw.rectangle(((x, y + size - width), (x + width, y)), fill='black')
-        draw.rectangle(((x + 2*width, y + size - width), (x + 3*width, y)), fill='black')
-        draw.rectangle(((x + 4*width, y + size - width), (x + size, y)), fill='black')
+        draw.rectangle(((x, y + size - width), (x + size, y + size)), fill='black')
+        draw.rectangle(((x, y), (x + width, y + size - width)), fill='black')
+        draw.rectangle(((x + 2*width, y), (x + 3*width, y + size - width)), fill='black')
+        draw.rectangle(((x + 4*width, y), (x + size, y + size - width)), fill='black')
+
+    def glyph_sources(self):
+        return [(0, None), (0, Image.ROTATE_270), (0, Image.ROTATE_180), (0, Image.ROTATE_90)]
 
     def symbol_renderers(self):
         return [EChart.draw_e,
@@ -391,3 +861,29 @@ class EChart(EyeChart):
         return [2, 3, 4,
                 5, 6, 6, 7, 7, 7,
                 8, 8, 8]
+
+
+CHART_TYPES = ('golovin_sivtsev', 'golovin_sivtsev_k_alt', 'landolt_c', 'e_chart')
+
+GENERATORS = ('random', 'smart_random', 'standard', 'shifted', 'global_shuffle', 'line_shuffle', 'shifted_line_shuffle')
+
+MODES = ('1', 'L', 'RGB')
+
+
+def check_seed(seed):
+    # seeds reproducing a chart are the ones numpy random generators and the output cache take alike
+    if seed is not None and not (isinstance(seed, int) and 0 <= seed < 2**32):
+        raise ValueError('Seed should be within 0 and 2**32 - 1')
+
+
+def create_chart(chart_type):
+    if 'golovin_sivtsev' == chart_type:
+        return GolovinSivtsev()
+    elif 'golovin_sivtsev_k_alt' == chart_type:
+        return GolovinSivtsev(k_alt=True)
+    elif 'landolt_c' == chart_type:
+        return LandoltC()
+    elif 'e_chart' == chart_type:
+        return EChart()
+    else:
+        raise NotImplementedError(chart_type)
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+
+from canvas import RasterCanvas
+from charts import EyeChart
+
+
+def packed(image):
+    # rows of a '1' image packed 8 pixels per byte, set bits are white, as by np.packbits
+    return np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(image.height, -1)
+
+
+class ChartCompositor:
+
+    # black and white charts composited by numpy many charts at once, every chart has the same background and symbol
+    # positions, so a symbol position of all charts is filled by a single indexing of the glyph table
+
+    def __init__(self, chart, dpi, sheets=(1, 2, 3)):
+
+        self.chart = chart
+        self.dpi = dpi
+        self.sheets = sheets
+        self.width, self.height = EyeChart.sheet_size(dpi)
+        self.row_bytes = -(-self.width // 8)
+        self.background = np.vstack([packed(chart.draw_background(RasterCanvas(self.width, self.height, '1'),
+                                                                  sheet).result())
+                                     for sheet in sheets])
+
+        # index of the first symbol of every sheet in the symbol sequence of a chart
+        starts = np.cumsum([0] + [sum(lengths) for lengths in chart.sheet_lengths()])
+        # every symbol position is the symbol index, the rows and the bytes of the charts it covers and the glyphs of
+        # all symbols covering them
+        self.positions = []
+        for i, sheet in enumerate(sheets):
+            j = starts[sheet - 1]
+            for y, xs, size in chart.sheet_table(sheet, self.width, self.height)['lines']:
+                for x in xs:
+                    table, left, top = self.glyph_table(size, x, y)
+                    # at the same position as by EyeChart.paste_symbol, glyphs are clipped to the sheet
+                    side = table.shape[1]
+                    rows = max(0, -top), min(side, self.height - top)
+                    columns = max(0, -(left // 8)), min(table.shape[2], self.row_bytes - left // 8)
+                    if rows[0] < rows[1] and columns[0] < columns[1]:
+                        top += i * self.height
+                        self.positions.append((j, slice(top + rows[0], top + rows[1]),
+                                               slice(left // 8 + columns[0], left // 8 + columns[1]),
+                                               table[:, rows[0]:rows[1], columns[0]:columns[1]]))
+                    j += 1
+
+    def glyph_table(self, size, x, y):
+        # glyphs of all symbols drawn at the position, shifted right by the position within its byte and packed, bits
+        # of the symbol are cleared, so that a glyph is drawn by a bitwise and
+        glyphs = [self.chart.glyph(symbol, size, x, y) for symbol in range(len(self.chart.symbol_renderers()))]
+        _, left, top = glyphs[0]
+        side = glyphs[0][0].width
+        ink = np.stack([np.unpackbits(packed(mask), axis=1)[:, :side] for mask, _, _ in glyphs]).astype(bool)
+        shift = left % 8
+        shifted = np.zeros((len(glyphs), side, -(-(side + shift) // 8) * 8), dtype=bool)
+        shifted[:, :, shift:shift + side] = ink
+        return np.packbits(~shifted, axis=2), left, top
+
+    def shape(self, n_charts):
+        return n_charts, len(self.sheets) * self.height, self.row_bytes
+
+    def compose(self, symbols, out=None, chunk=256):
+        # symbols are rows sampled by BatchSampler, charts are composited by chunks to keep the temporaries small
+        symbols = np.asarray(symbols)
+        if out is None:
+            out = np.empty(self.shape(len(symbols)), dtype=np.uint8)
+        for start in range(0, len(symbols), chunk):
+            with EyeChart.profiler.phase('compose'):
+                block = out[start:start + chunk]
+                rows = symbols[start:start + chunk]
+                block[:] = self.background
+                for j, ys, xs, glyphs in self.positions:
+                    block[:, ys, xs] &= glyphs[rows[:, j]]
+        return out
+
+    def save(self, filename, symbols, chunk=256):
+        if '.npy' != os.path.splitext(filename)[1].lower():
+            raise ValueError('Charts are saved to .npy file')
+        EyeChart.make_dirs(filename)
+        # memory mapped, so that the number of charts is limited by the disk
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=self.shape(len(symbols)))
+        self.compose(symbols, out, chunk)
+        out.flush()
+        return out
+
+    def check(self, symbols, charts):
+        # indices of the composited charts which differ from the charts drawn by PIL with the same symbols
+        mismatches = []
+        for i, (row, composited) in enumerate(zip(symbols, charts)):
+            images = self.chart.render('standard', self.dpi, False, '1', row)
+            expected = np.vstack([packed(images[sheet - 1]) for sheet in self.sheets])
+            if not np.array_equal(expected, composited):
+                mismatches.append(i)
+        return mismatches
@@ -0,0 +1,89 @@
+import numpy as np
+from PIL import Image
+
+from canvas import RasterCanvas
+from charts import EyeChart
+
+
+class LiveDisplay:
+
+    # viewing distance the printed sheets are designed for, D = 5 / V
+    DESIGN_DISTANCE_M = 5
+
+    def __init__(self, chart, width, height, pixel_pitch_mm, distance_m, sheet=1, rng=None):
+
+        self.chart = chart
+        self.width = width
+        self.height = height
+        self.sheet = sheet
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        # pixels per millimetre of the printed sheet, so that the screen is seen from the distance at the same
+        # angles as the print from the design distance
+        scale = distance_m / LiveDisplay.DESIGN_DISTANCE_M / pixel_pitch_mm
+        sheet_width, sheet_height = int(EyeChart.A4_WIDTH_MM * scale), int(EyeChart.A4_HEIGHT_MM * scale)
+        if sheet_width > width or sheet_height > height:
+            raise ValueError('Sheet of %dx%d pixels does not fit the screen of %dx%d pixels, the distance is too long '
+                             'for the pixel pitch' % (sheet_width, sheet_height, width, height))
+        self.origin = ((width - sheet_width) // 2, (height - sheet_height) // 2)
+        # the sheet read from the distance is the A4 layout scaled as a page of the same proportions, so that the D
+        # labels give the distances the lines are read from by normal vision
+        ratio = distance_m / LiveDisplay.DESIGN_DISTANCE_M
+        self.page_size = (EyeChart.A4_WIDTH_MM * ratio, EyeChart.A4_HEIGHT_MM * ratio)
+        self.table = chart.sheet_table(sheet, sheet_width, sheet_height, self.page_size)
+
+        # the frame buffer is reused by every chart, labels are drawn once, symbols are redrawn line by line
+        self.frame = Image.new('L', (width, height), color='white')
+        background = chart.draw_background(RasterCanvas(sheet_width, sheet_height, 'L'), sheet, self.page_size)
+        self.frame.paste(background.result(), self.origin)
+        self.symbols = [None] * len(self.table['lines'])
+
+        # glyphs of every symbol in every line size are rasterized up front, so that showing a chart only pastes them
+        for _, _, size in self.table['lines']:
+            for symbol in range(len(chart.symbol_renderers())):
+                chart.antialiased_glyph(symbol, size)
+
+    def line_box(self, line):
+        y, xs, size = self.table['lines'][line]
+        margin = int(size / 5) + 2
+        side = 2*margin + int(size) + 1
+        left, top = self.origin
+        return (left + round(xs[0]) - margin, top + round(y) - margin,
+                left + round(xs[-1]) - margin + side, top + round(y) - margin + side)
+
+    def show(self, lines):
+        # only lines with other symbols than shown are redrawn, boxes of the redrawn lines are returned for blitting
+        left, top = self.origin
+        boxes = []
+        for i, ((y, xs, size), symbols) in enumerate(zip(self.table['lines'], lines)):
+            symbols = [int(symbol) for symbol in symbols]
+            if symbols == self.symbols[i]:
+                continue
+            box = self.line_box(i)
+            self.frame.paste(255, box)
+            for x, symbol in zip(xs, symbols):
+                mask, margin = self.chart.antialiased_glyph(symbol, size)
+                self.frame.paste(0, (left + round(x) - margin, top + round(y) - margin), mask)
+            self.symbols[i] = symbols
+            boxes.append(box)
+        return boxes
+
+    def new_chart(self, generator_name='smart_random'):
+        # the symbols of the sheet are the ones it would have in the printed chart
+        generator = self.chart.symbol_generator(generator_name, rng=self.rng)
+        generator = self.chart.sheet_generators(generator)[self.sheet - 1]
+        return self.show([generator.next_symbols(len(xs)) for _, xs, _ in self.table['lines']])
+
+    def reshuffle_line(self, line, attempts=10):
+        symbols = list(self.symbols[line])
+        for _ in range(attempts):
+            self.rng.shuffle(symbols)
+            if symbols != self.symbols[line]:
+                break
+        lines = list(self.symbols)
+        lines[line] = symbols
+        return self.show(lines)
+
+    def frame_bytes(self):
+        # 8 bit grayscale pixels, row by row
+        return self.frame.tobytes()
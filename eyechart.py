@@ -1,41 +1,208 @@
 import argparse
+import os
+import sys
+import time
 
-from charts import GolovinSivtsev, LandoltC, EChart
+import numpy as np
+
+# modules of other commands are imported when used, since a single chart is often rendered by a process of its own
+from charts import CHART_TYPES, GENERATORS, MODES, EyeChart, check_seed, create_chart
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--type', default='golovin_sivtsev',
-                        choices=('golovin_sivtsev', 'golovin_sivtsev_k_alt', 'landolt_c', 'e_chart'),
+    parser.add_argument('command', nargs='?', default='render', choices=('render', 'serve', 'display', 'dataset'),
+                        help='Command: "render" to save a chart to files, "serve" to run HTTP server rendering '
+                             'charts on demand at /chart?type=...&generator=...&dpi=...&format=png|pdf|svg&sheet=1|2|3 '
+                             'with request latency metrics at /metrics, "display" to render a sheet for a screen '
+                             'of given pixel pitch seen from given distance, or "dataset" to composite many black and '
+                             'white charts into a bit-packed array saved to .npy file')
+    parser.add_argument('-t', '--type', default='golovin_sivtsev', choices=CHART_TYPES,
                         help='Eyechart type: "golovin_sivtsev" for Golovin-Sivtsev table,  "golovin_sivtsev_k_alt" '
                              'for Golovin-Sivtsev table with altered K letter, "landolt_c" for'
                              'Landolt C table, or "e_chart" for E-chart')
     parser.add_argument('-g', '--generator', default='smart_random',
-                        choices=('random', 'smart_random', 'standard', 'shifted', 'global_shuffle', 'line_shuffle',
-                                 'shifted_line_shuffle'),
+                        choices=GENERATORS,
                         help='Symbol generator type: "random" for purely random symbol appearance, "smart_random" for '
                              'random appearance where some efforts are made to avoid symbol repetition, "standard" '
                              'for standard symbol appearance, "shifted" for symbol appearance shifted with respect '
                              'to the standard once (Caesar cypher), "global_shuffle" for standard symbols globally '
                              'shuffled, "line_shuffle" for standard symbols shuffled line-wise, and '
                              '"shifted_line_shuffle" for combination of "line_shuffled: and "shifted"')
+    parser.add_argument('--no-repeat', action='store_true',
+                        help='Never place the same symbol twice in a row within a line')
+    parser.add_argument('-i', '--index',
+                        help='Index file of issued charts, a chart found in the index is resampled, so that no chart '
+                             'is issued twice')
+    parser.add_argument('--seed', type=int,
+                        help='Seed of the symbol generator, the same seed reproduces the same chart, in batch mode '
+                             'the same batch whatever the number of workers')
+    parser.add_argument('--cache-dir',
+                        help='Directory to keep the files of reproducible charts, seeded or standard, the same chart '
+                             'saved again is copied from there instead of being rendered')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Size limit of the cache directory in MB, least recently used charts are evicted')
+    parser.add_argument('--background-dir',
+                        help='Directory to keep the rendered static parts of the sheets, labels and rules, so that '
+                             'they are drawn once per chart type, resolution and image mode')
     parser.add_argument('-s', '--single', action='store_true', help='Single file, or 3 files to be printed on A4')
-    parser.add_argument('-dpi', '--dots-per-inch', default=600, help='The output files resolution')
-    parser.add_argument('-f', '--filename', default='table.png',
-                        help='Output filename. For 3 files option index 1, 2, 3 is inserted before file extension.'
-                             'Image compression is defined by extension, which is mandatory')
+    parser.add_argument('--stream', action='store_true',
+                        help='Single file option: encode sheets one by one as soon as they are rendered instead of '
+                             'composing the whole image in memory, PNG and TIFF files only')
+    parser.add_argument('-p', '--parallel', action='store_true',
+                        help='Draw the sheets concurrently, and encode every sheet while others are drawn, the output '
+                             'is the same as without the option')
+    parser.add_argument('-dpi', '--dots-per-inch', default=600, type=int, help='The output files resolution')
+    parser.add_argument('--page-size',
+                        help='Page size in mm as WIDTHxHEIGHT of the single file or of each of the 3 files, not in '
+                             'batch mode, A4 by default, the sheets are scaled uniformly to fit the page and centred, '
+                             'and the distances D are scaled with them, so that a chart twice as high is read from '
+                             'twice the distances')
+    parser.add_argument('--tiled', nargs='?', type=int, const=1024,
+                        help='Draw the sheets of the single file or of each of the 3 files, not in batch mode, into '
+                             'square tiles of given size, 1024 pixels by default, in a file on disk instead of memory, '
+                             'and save them as tiled TIFF, or BigTIFF when over 4 GB, for wall charts and very high '
+                             'resolutions')
+    parser.add_argument('-f', '--filename',
+                        help='Output filename, table.png by default, or table.npy in dataset mode. For 3 files option '
+                             'index 1, 2, 3 is inserted before file extension. Image compression is defined by '
+                             'extension, which is mandatory, .svg and .pdf extensions produce vector graphics, a PDF '
+                             'file contains a page per sheet, datasets are saved to .npy files only')
+    parser.add_argument('-m', '--mode', default='RGB', choices=MODES,
+                        help='Image mode: "1" for black and white, "L" for grayscale with antialiased labels, '
+                             'or "RGB" for color')
+    parser.add_argument('--profile', nargs='?', const='profile.json',
+                        help='Single chart option: time sampling, glyph drawing, labels, composing and encoding, count '
+                             'drawing calls per glyph, print the table and save it to JSON file, profile.json by '
+                             'default')
+    parser.add_argument('-n', '--count', type=int,
+                        help='Batch mode: number of charts to render, chart index is appended to the filename, '
+                             'e.g. table_00001_1.png')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Batch and server mode: number of worker processes, by default the number of CPUs')
+    parser.add_argument('--screen', default='1920x1080', help='Display mode: screen resolution in pixels')
+    parser.add_argument('--pixel-pitch', type=float, default=0.25, help='Display mode: screen pixel pitch in mm')
+    parser.add_argument('--distance', type=float, default=5, help='Display mode: viewing distance in metres')
+    parser.add_argument('--sheet', type=int, choices=(1, 2, 3),
+                        help='Display and dataset mode: sheet to display, the first one by default, or to composite, '
+                             'the whole chart by default')
+    parser.add_argument('--check', type=int, default=0,
+                        help='Dataset mode: number of the first charts compared with the charts drawn by PIL pixel '
+                             'for pixel')
+    parser.add_argument('--worker', action='store_true',
+                        help='Worker mode: read jobs from standard input, a JSON object per line with any of "id", '
+                             '"type", "generator", "dpi", "filename", "single", "mode", "stream", "parallel", '
+                             '"no_repeat" and "seed" keys, the options not given are taken from the command line, and '
+                             'write a JSON result per job with "files" saved or "error" to standard output')
+    parser.add_argument('--host', default='127.0.0.1', help='Server mode: address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='Server mode: port to listen on')
 
     args = parser.parse_args()
+    try:
+        check_seed(args.seed)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.filename is None:
+        args.filename = 'table.npy' if 'dataset' == args.command else 'table.png'
 
-    if args.type == 'golovin_sivtsev':
-        table = GolovinSivtsev()
-    elif args.type == 'golovin_sivtsev_k_alt':
-        table = GolovinSivtsev(k_alt=True)
-    elif args.type == 'landolt_c':
-        table = LandoltC()
-    elif args.type == 'e_chart':
-        table = EChart()
+    if args.worker:
+        from worker import serve_jobs
+        defaults = {'id': None, 'type': args.type, 'generator': args.generator, 'dpi': args.dots_per_inch,
+                    'filename': args.filename, 'single': args.single, 'mode': args.mode, 'stream': args.stream,
+                    'parallel': args.parallel, 'no_repeat': args.no_repeat, 'seed': args.seed}
+        serve_jobs(sys.stdin, sys.stdout, defaults, args.index, args.background_dir, args.cache_dir,
+                   args.cache_size * 1024 * 1024)
+    elif 'display' == args.command:
+        from display import LiveDisplay
+        width, height = (int(value) for value in args.screen.lower().split('x'))
+        display = LiveDisplay(create_chart(args.type), width, height, args.pixel_pitch, args.distance, args.sheet or 1,
+                              np.random.default_rng(args.seed))
+        start = time.perf_counter()
+        display.new_chart(args.generator)
+        elapsed = time.perf_counter() - start
+        EyeChart.make_dirs(args.filename)
+        if '.raw' == os.path.splitext(args.filename)[1].lower():
+            # 8 bit grayscale pixels, row by row, to be blitted by a viewer
+            with open(args.filename, 'wb') as file:
+                file.write(display.frame_bytes())
+        else:
+            display.frame.save(args.filename)
+        print('Frame of %dx%d pixels rendered in %.2f ms, file %s saved' % (width, height, 1000 * elapsed,
+                                                                            args.filename))
+    elif 'dataset' == args.command:
+        from compositor import ChartCompositor
+        # options are checked before sampling, which takes a while for large datasets
+        if args.count is None:
+            parser.error('Number of charts of the dataset should be given by -n option')
+        if '.npy' != os.path.splitext(args.filename)[1].lower():
+            parser.error('Dataset is saved to .npy file')
+        start = time.perf_counter()
+        table = create_chart(args.type)
+        index = None
+        if args.index:
+            from index import ChartIndex
+            index = ChartIndex(args.index)
+        symbols = table.sample_symbols(args.generator, args.count, args.no_repeat, index,
+                                       rng=np.random.default_rng(args.seed))
+        compositor = ChartCompositor(table, args.dots_per_inch, (args.sheet,) if args.sheet else (1, 2, 3))
+        charts = compositor.save(args.filename, symbols)
+        # symbols of every chart, line by line, are the labels of the images
+        file, ext = os.path.splitext(args.filename)
+        np.save('%s_symbols%s' % (file, ext), symbols)
+        elapsed = time.perf_counter() - start
+        print('%d charts of %dx%d pixels composited in %.1f s, %.2f charts/s, files %s and %s_symbols%s saved'
+              % (args.count, compositor.width, charts.shape[1], elapsed, args.count / elapsed, args.filename,
+                 file, ext))
+        if args.check:
+            mismatches = compositor.check(symbols[:args.check], charts[:args.check])
+            checked = min(args.check, args.count)
+            print('%d of %d charts match the charts drawn by PIL' % (checked - len(mismatches), checked))
+            if mismatches:
+                sys.exit(1)
+    elif 'serve' == args.command:
+        from server import serve
+        serve(args.host, args.port, args.workers, args.index, args.background_dir, args.cache_dir,
+              args.cache_size * 1024 * 1024)
+    elif args.count is not None:
+        from batch import render_batch
+        elapsed = render_batch(args.type, args.generator, args.dots_per_inch, args.filename, args.single,
+                               args.count, args.workers, args.mode, args.stream, args.no_repeat, args.index,
+                               args.background_dir, args.seed)
+        print('%d charts rendered in %.1f s, %.2f charts/s' % (args.count, elapsed, args.count / elapsed))
     else:
-        raise NotImplementedError(args.type)
-
-    table.save(args.generator, args.dots_per_inch, args.filename, args.single)
+        # options are checked before a chart is claimed in the index
+        page_size = None
+        if args.page_size:
+            try:
+                page_size = tuple(float(value) for value in args.page_size.lower().split('x'))
+            except ValueError:
+                page_size = ()
+            if len(page_size) != 2 or min(page_size) <= 0:
+                parser.error('Page size should be given as WIDTHxHEIGHT in mm, e.g. 594x418')
+        if args.tiled is not None:
+            if args.tiled <= 0 or args.tiled % 16:
+                parser.error('Tile size should be a positive multiple of 16')
+            if os.path.splitext(args.filename)[1].lower() not in ('.tif', '.tiff'):
+                parser.error('Tiled charts are saved to TIFF files only')
+        EyeChart.background_cache.directory = args.background_dir
+        if args.profile:
+            from profiling import Profiler
+            EyeChart.profiler = Profiler()
+        table = create_chart(args.type)
+        cache = None
+        if args.cache_dir:
+            from cache import OutputCache
+            cache = OutputCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        symbols = None
+        if args.no_repeat or args.index:
+            from index import ChartIndex
+            index = ChartIndex(args.index) if args.index else None
+            symbols = table.sample_symbols(args.generator, 1, args.no_repeat, index,
+                                           rng=np.random.default_rng(args.seed))[0]
+        table.save(args.generator, args.dots_per_inch, args.filename, args.single, mode=args.mode,
+                   stream=args.stream, symbols=symbols, parallel=args.parallel, seed=args.seed, cache=cache,
+                   page_size=page_size, tile_size=args.tiled)
+        if args.profile:
+            print(EyeChart.profiler.table())
+            EyeChart.profiler.save(args.profile)
+            print('Profile saved to %s' % args.profile)
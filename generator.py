@@ -3,23 +3,24 @@ import numpy as np
 
 class RandomGenerator:
     
-    def __init__(self, n_symbols, smart=False, offset=2):
+    def __init__(self, n_symbols, smart=False, offset=2, rng=None):
         
         self.n_symbols = n_symbols
         self.smart = smart
         self.offset = offset
+        self.rng = rng if rng is not None else np.random.default_rng()
     
     def next_symbols(self, n):
         
         if not self.smart:
-            symbols = np.random.randint(0, self.n_symbols, n)
+            symbols = self.rng.integers(0, self.n_symbols, n)
         else:
             symbols = list(range(self.n_symbols))
-            np.random.shuffle(symbols)
+            self.rng.shuffle(symbols)
 
             while len(symbols) < n:
                 new_symbols = symbols[-self.n_symbols:-self.offset]
-                np.random.shuffle(new_symbols)
+                self.rng.shuffle(new_symbols)
                 symbols += new_symbols
             
         return symbols[:n]
@@ -27,11 +28,15 @@ class RandomGenerator:
 
 class SequenceGenerator:
     
-    def __init__(self, sequence, global_shift=0, shuffle=None):
+    def __init__(self, sequence, global_shift=0, shuffle=None, rng=None):
         
         self.sequence = sequence[global_shift:] + sequence[:global_shift]
+        if rng is None and shuffle is not None:
+            # sequences which are not shuffled, e.g. sampled rows, need no random state
+            rng = np.random.default_rng()
+        self.rng = rng
         if 'global' == shuffle:
-            np.random.shuffle(self.sequence)
+            self.rng.shuffle(self.sequence)
         self.shuffle_line = 'line' == shuffle
         
         self.shift = 0
@@ -39,6 +44,150 @@ class SequenceGenerator:
     def next_symbols(self, n):
         symbols = self.sequence[self.shift:self.shift+n]
         if self.shuffle_line:
-            np.random.shuffle(symbols)
+            self.rng.shuffle(symbols)
         self.shift += n
         return symbols
+
+
+class BatchSampler:
+
+    def __init__(self, n_symbols, sequence, line_lengths, offset=2, rng=None):
+
+        self.n_symbols = n_symbols
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.sequence = np.asarray(sequence)
+        self.line_lengths = line_lengths
+        self.offset = offset
+
+        self.length = sum(line_lengths)
+        self.line_index = np.repeat(np.arange(len(line_lengths)), line_lengths)
+        # neighbours within a line, symbols at the end and the start of the next line are not adjacent
+        self.same_line = self.line_index[1:] == self.line_index[:-1]
+
+    def repeated_lines(self, symbols):
+        repeated = (symbols[:, 1:] == symbols[:, :-1]) & self.same_line
+        lines = np.zeros((len(symbols), len(self.line_lengths)), dtype=bool)
+        rows, positions = np.nonzero(repeated)
+        lines[rows, self.line_index[1:][positions]] = True
+        return lines
+
+    def repeats(self, symbols):
+        return ((symbols[:, 1:] == symbols[:, :-1]) & self.same_line).any(axis=1)
+
+    def random(self, n_charts, no_repeat=False):
+        if not no_repeat:
+            return self.rng.integers(0, self.n_symbols, (n_charts, self.length))
+        # every next symbol is uniformly chosen among the symbols other than the previous one
+        steps = self.rng.integers(1, self.n_symbols, (n_charts, self.length))
+        steps[:, 0] = self.rng.integers(0, self.n_symbols, n_charts)
+        return np.cumsum(steps, axis=1) % self.n_symbols
+
+    def smart_random(self, n_charts):
+        # same as RandomGenerator(smart=True) drawing a chart line by line, every line starts with a shuffle of all
+        # symbols and each next block is a shuffle of the last n_symbols symbols of the line but the most recent ones
+        n_lines = len(self.line_lengths)
+        lines = self.smart_random_lines(n_charts * n_lines, max(self.line_lengths)).reshape(n_charts, n_lines, -1)
+        starts = np.cumsum([0] + list(self.line_lengths[:-1]))
+        return lines[:, self.line_index, np.arange(self.length) - starts[self.line_index]]
+
+    def smart_random_lines(self, n_lines, length):
+        # lines of the given length, a shorter line is the same as the beginning of a longer one
+        rows = np.arange(n_lines)[:, None]
+        blocks = [np.argsort(self.rng.random((n_lines, self.n_symbols)), axis=1)]
+        window = blocks[0]
+        size = self.n_symbols
+        while size < length:
+            candidates = window[:, :-self.offset]
+            blocks.append(candidates[rows, np.argsort(self.rng.random(candidates.shape), axis=1)])
+            window = np.hstack([window, blocks[-1]])[:, -self.n_symbols:]
+            size += candidates.shape[1]
+        return np.hstack(blocks)[:, :length]
+
+    def shifted(self, n_charts, shuffle_line=False):
+        shifts = self.rng.integers(0, len(self.sequence), (n_charts, 1))
+        symbols = self.sequence[(np.arange(self.length) + shifts) % len(self.sequence)]
+        return self.shuffle_lines(symbols) if shuffle_line else symbols
+
+    def standard(self, n_charts):
+        return np.tile(self.sequence[:self.length], (n_charts, 1))
+
+    def global_shuffle(self, n_charts):
+        order = np.argsort(self.rng.random((n_charts, len(self.sequence))), axis=1)
+        return self.sequence[order][:, :self.length]
+
+    def shuffle_lines(self, symbols, lines=None):
+        # random keys are within [0, 1), so sorting by line index plus the key permutes symbols within lines only
+        keys = self.rng.random(symbols.shape)
+        if lines is not None:
+            # lines not selected keep their order
+            keys = np.where(lines[:, self.line_index], keys, np.arange(self.length) / self.length)
+        order = np.argsort(self.line_index + keys, axis=1)
+        return symbols[np.arange(len(symbols))[:, None], order]
+
+    def line_shuffle(self, n_charts):
+        return self.shuffle_lines(self.standard(n_charts))
+
+    def draw(self, generator_name, n_charts):
+        if 'standard' == generator_name:
+            return self.standard(n_charts)
+        elif 'shifted' == generator_name:
+            return self.shifted(n_charts)
+        elif 'global_shuffle' == generator_name:
+            return self.global_shuffle(n_charts)
+        elif 'line_shuffle' == generator_name:
+            return self.line_shuffle(n_charts)
+        elif 'shifted_line_shuffle' == generator_name:
+            return self.shifted(n_charts, shuffle_line=True)
+        elif 'random' == generator_name:
+            return self.random(n_charts)
+        elif 'smart_random' == generator_name:
+            return self.smart_random(n_charts)
+        else:
+            raise NotImplementedError(generator_name)
+
+    def global_shuffle_no_repeat(self, n_charts):
+        # symbols are drawn one by one without replacement excluding the previous symbol in the line, which rarely
+        # ends up with the previous symbol left only, such charts have repeats and are to be redrawn
+        rows = np.arange(n_charts)
+        counts = np.tile(np.bincount(self.sequence, minlength=self.n_symbols), (n_charts, 1))
+        symbols = np.zeros((n_charts, self.length), dtype=int)
+        for i in range(self.length):
+            weights = counts.astype(float)
+            if i and self.same_line[i - 1]:
+                weights[rows, symbols[:, i - 1]] = 0
+            cumulative = np.cumsum(weights, axis=1)
+            draws = self.rng.random(n_charts) * cumulative[:, -1]
+            choice = np.minimum((cumulative <= draws[:, None]).sum(axis=1), self.n_symbols - 1)
+            # when only the previous symbol is left it is repeated
+            choice = np.where(cumulative[:, -1] > 0, choice, symbols[:, i - 1])
+            symbols[:, i] = choice
+            counts[rows, choice] -= 1
+        return symbols
+
+    def sample(self, generator_name, n_charts, no_repeat=False, max_attempts=1000, redraw_every=20):
+
+        if 'random' == generator_name:
+            return self.random(n_charts, no_repeat)
+        elif not no_repeat:
+            return self.draw(generator_name, n_charts)
+
+        if 'global_shuffle' == generator_name:
+            draw = self.global_shuffle_no_repeat
+        else:
+            draw = lambda n: self.draw(generator_name, n)
+        # lines with a symbol repeated in a row are reshuffled if the generator shuffles lines, otherwise, or if
+        # reshuffling does not help since a shifted line has too many same symbols, charts having repeats are redrawn
+        reshuffle = generator_name in ('line_shuffle', 'shifted_line_shuffle')
+
+        symbols = draw(n_charts)
+        for attempt in range(max_attempts):
+            lines = self.repeated_lines(symbols)
+            redraw = np.flatnonzero(lines.any(axis=1))
+            if not len(redraw):
+                return symbols
+            if reshuffle and (attempt + 1) % redraw_every:
+                symbols[redraw] = self.shuffle_lines(symbols[redraw], lines[redraw])
+            else:
+                symbols[redraw] = draw(len(redraw))
+
+        raise ValueError('Failed to avoid repeated symbols with %s generator' % generator_name)
@@ -0,0 +1,60 @@
+import hashlib
+import sqlite3
+import time
+
+import numpy as np
+
+
+def chart_fingerprint(chart_name, symbols):
+    # symbols of all lines in order, line lengths are defined by the chart, so lines need no separators,
+    # the digest is 64 bit long, a false collision only makes a chart to be resampled
+    digest = hashlib.blake2b(chart_name.encode('utf-8') + b'\0', digest_size=8)
+    digest.update(np.asarray(symbols, dtype=np.uint8).tobytes())
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+class ChartIndex:
+
+    def __init__(self, path, timeout=60, mmap_size=256 * 1024 * 1024, attempts=50):
+        # autocommit mode, every claim is a transaction of its own unless done in bulk
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        for attempt in range(attempts):
+            try:
+                # write ahead log lets concurrent processes read while one of them writes
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('PRAGMA synchronous=NORMAL')
+                self.connection.execute('PRAGMA mmap_size=%d' % mmap_size)
+                # the fingerprint is the rowid, so the table is a single b-tree without separate index
+                self.connection.execute('CREATE TABLE IF NOT EXISTS charts (fingerprint INTEGER PRIMARY KEY)')
+                break
+            except sqlite3.OperationalError:
+                # switching a new database to write ahead log ignores the busy timeout when processes race
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.01 * (attempt + 1))
+
+    def __contains__(self, fingerprint):
+        cursor = self.connection.execute('SELECT 1 FROM charts WHERE fingerprint = ?', (fingerprint,))
+        return cursor.fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM charts').fetchone()[0]
+
+    def claim(self, fingerprint):
+        # atomic check and insert, False if the chart has been issued before, possibly by another process
+        return self.connection.execute('INSERT OR IGNORE INTO charts VALUES (?)', (fingerprint,)).rowcount == 1
+
+    def claim_many(self, fingerprints):
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            claimed = [cursor.execute('INSERT OR IGNORE INTO charts VALUES (?)', (fingerprint,)).rowcount == 1
+                       for fingerprint in fingerprints]
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return claimed
+
+    def close(self):
+        self.connection.close()
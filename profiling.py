@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# reusable context of a disabled phase
+NO_PHASE = nullcontext()
+
+
+class NullProfiler:
+
+    # profiler in use when profiling is disabled, every method does nothing
+
+    def phase(self, name):
+        return NO_PHASE
+
+    def count(self, name, n=1):
+        pass
+
+    def draw(self, draw, name):
+        return draw
+
+    def memory(self, name):
+        pass
+
+
+class CountingDraw:
+
+    # ImageDraw proxy counting the calls of every drawing method
+
+    def __init__(self, draw, profiler, name):
+        self.draw = draw
+        self.profiler = profiler
+        self.name = name
+
+    def __getattr__(self, method):
+        function = getattr(self.draw, method)
+
+        def call(*args, **kwargs):
+            self.profiler.count('draw calls/%s/%s' % (self.name, method))
+            return function(*args, **kwargs)
+
+        return call
+
+
+class Profiler(NullProfiler):
+
+    def __init__(self, hook=None):
+        # hook is called with the phase name and its duration in seconds when a phase ends
+        self.hook = hook
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.rss_growth_mb = {}
+        self.last_peak_rss_mb = Profiler.peak_rss_mb()
+        # sheets may be drawn by concurrent threads, durations of concurrent phases add up
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                calls, seconds = self.phases.get(name, (0, 0.))
+                self.phases[name] = (calls + 1, seconds + elapsed)
+            if self.hook is not None:
+                self.hook(name, elapsed)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def draw(self, draw, name):
+        return CountingDraw(draw, self, name)
+
+    def memory(self, name):
+        # growth of the peak resident memory since the previous step, images are not seen by tracemalloc, the peak
+        # is a high-water mark of the process, so a step reusing the memory of the steps before it shows no growth
+        peak_rss_mb = Profiler.peak_rss_mb()
+        with self.lock:
+            self.rss_growth_mb[name] = self.rss_growth_mb.get(name, 0.) + peak_rss_mb - self.last_peak_rss_mb
+            self.last_peak_rss_mb = peak_rss_mb
+
+    @staticmethod
+    def peak_rss_mb():
+        # json and resource are imported by profiled runs only, since every run imports the null profiler
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def report(self):
+        return {'wall_s': time.perf_counter() - self.start,
+                'phases': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in sorted(self.phases.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'rss_growth_mb': dict(self.rss_growth_mb)}
+
+    def table(self):
+        report = self.report()
+        lines = ['%-40s %8s %10s %10s %7s' % ('phase', 'calls', 'total, s', 'mean, ms', 'share')]
+        for name, phase in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append('%-40s %8d %10.4f %10.4f %6.1f%%' % (name, phase['calls'], phase['seconds'],
+                                                             1000 * phase['seconds'] / phase['calls'],
+                                                             100 * phase['seconds'] / report['wall_s']))
+        lines.append('%-40s %8s %10.4f' % ('wall', '', report['wall_s']))
+        if report['counters']:
+            lines.append('')
+            lines.append('%-40s %8s' % ('counter', 'count'))
+            lines += ['%-40s %8d' % item for item in report['counters'].items()]
+        if report['rss_growth_mb']:
+            lines.append('')
+            lines.append('%-40s %14s' % ('step', 'RSS growth, MB'))
+            lines += ['%-40s %14.1f' % item for item in report['rss_growth_mb'].items()]
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        import json
+        with open(filename, 'w') as file:
+            json.dump(self.report(), file, indent=2)
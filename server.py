@@ -0,0 +1,243 @@
+import asyncio
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from cache import OutputCache
+from charts import CHART_TYPES, GENERATORS, MODES, EyeChart, check_seed, create_chart
+from index import ChartIndex
+from writers import write_pdf
+
+CONTENT_TYPES = {'PNG': 'image/png',
+                 'TIFF': 'image/tiff',
+                 'BMP': 'image/bmp',
+                 'PDF': 'application/pdf',
+                 'SVG': 'image/svg+xml'}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# size of the chunks the response body is streamed by
+CHUNK_SIZE = 64 * 1024
+
+# chart objects of the worker process by chart type, as the chart of a batch worker
+charts = {}
+
+# index of issued charts, every worker has its own connection
+index = None
+
+# encoded reproducible charts, shared by the workers through the directory
+cache = None
+
+# entropy of the worker process, spawning a random stream per unseeded chart
+seed_sequence = None
+
+
+def init_worker(index_path=None, background_dir=None, cache_dir=None, cache_size=1024 * 1024 * 1024):
+    global index, cache, seed_sequence
+    # drawn from the OS by every worker, so forked workers never share a random state
+    seed_sequence = np.random.SeedSequence()
+    EyeChart.background_cache.directory = background_dir
+    for chart_type in CHART_TYPES:
+        charts[chart_type] = create_chart(chart_type)
+    if index_path:
+        index = ChartIndex(index_path)
+    if cache_dir:
+        cache = OutputCache(cache_dir, cache_size)
+
+
+def render(chart_type, generator_name, dpi, mode, format, single, sheet, seed=None):
+
+    chart = charts[chart_type]
+
+    key = None
+    # charts of the index are new every time, other charts are reproducible when seeded or standard
+    if cache is not None and index is None and (seed is not None or 'standard' == generator_name):
+        key = chart.cache_key(generator_name, seed, dpi, 'chart.' + format.lower(), single, mode, False) + (sheet,)
+        body = cache.get(key)
+        if body is not None:
+            return body[0]
+
+    # a seeded chart has the stream the seed defines, the same as the chart saved with the seed
+    rng = np.random.default_rng(seed if seed is not None else seed_sequence.spawn(1)[0])
+    body = render_chart(chart, generator_name, dpi, mode, format, single, sheet, rng)
+
+    if key is not None:
+        cache.put(key, [body])
+    return body
+
+
+def render_chart(chart, generator_name, dpi, mode, format, single, sheet, rng):
+    symbols = chart.sample_symbols(generator_name, 1, index=index, rng=rng)[0] if index is not None else None
+    if sheet and 'SVG' == format:
+        return chart.render_bytes(generator_name, dpi, False, mode, format, symbols, rng)[sheet - 1]
+    elif sheet and 'PDF' == format:
+        # a single page document, all sheets are drawn to consume the generator in order
+        page = chart.vector_sheets(chart.symbol_generator(generator_name, symbols, rng))[sheet - 1]
+        buffer = io.BytesIO()
+        write_pdf(buffer, [[page]])
+        return buffer.getvalue()
+    elif sheet:
+        # the whole chart is drawn to consume the generator in order, but only the requested sheet is encoded
+        image = chart.render(generator_name, dpi, False, mode, symbols, rng)[sheet - 1]
+        buffer = io.BytesIO()
+        image.save(buffer, format=format)
+        return buffer.getvalue()
+    return chart.render_bytes(generator_name, dpi, single, mode, format, symbols, rng)[0]
+
+
+def parse_chart_query(query):
+
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+
+    chart_type = params.get('type', 'golovin_sivtsev')
+    if chart_type not in CHART_TYPES:
+        raise ValueError('Unknown chart type %s' % chart_type)
+    generator_name = params.get('generator', 'smart_random')
+    if generator_name not in GENERATORS:
+        raise ValueError('Unknown generator %s' % generator_name)
+    dpi = int(params.get('dpi', 600))
+    if not 10 <= dpi <= 2400:
+        raise ValueError('Resolution should be within 10 and 2400 dpi')
+    mode = params.get('mode', 'RGB')
+    if mode not in MODES:
+        raise ValueError('Unknown image mode %s' % mode)
+    format = params.get('format', 'png').upper()
+    if format not in CONTENT_TYPES:
+        raise ValueError('Unsupported format %s' % format)
+    sheet = int(params.get('sheet', 0))
+    if not 0 <= sheet <= 3:
+        raise ValueError('Sheet should be 1, 2 or 3')
+    # without a sheet the whole chart is returned, a PDF document has all sheets, a page per sheet unless single
+    single = params.get('single', '1' if 'PDF' != format else '0') in ('1', 'true', 'yes')
+    seed = int(params['seed']) if 'seed' in params else None
+    check_seed(seed)
+
+    return chart_type, generator_name, dpi, mode, format, single, sheet, seed
+
+
+class ChartServer:
+
+    def __init__(self, workers=None, queue_size=None, latency_window=1000, index_path=None, background_dir=None,
+                 cache_dir=None, cache_size=1024 * 1024 * 1024):
+        self.workers = workers or os.cpu_count() or 1
+        self.index_path = index_path
+        self.background_dir = background_dir
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        # renderings waiting for a worker are bounded, further requests wait before being submitted
+        self.queue_size = queue_size or 2 * self.workers
+        self.executor = None
+        self.slots = None
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    async def start(self, host='127.0.0.1', port=8000):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(self.index_path, self.background_dir, self.cache_dir,
+                                                      self.cache_size))
+        self.slots = asyncio.Semaphore(self.queue_size)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'workers': self.workers,
+                'latency_ms': {'mean': sum(latencies) / len(latencies) if latencies else None,
+                               'p50': percentile(0.5),
+                               'p95': percentile(0.95),
+                               'p99': percentile(0.99),
+                               'max': latencies[-1] if latencies else None}}
+
+    async def send(self, writer, status, content_type, body, headers=()):
+        head = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                'Content-Type: %s' % content_type,
+                'Transfer-Encoding: chunked',
+                'Connection: close']
+        head += ['%s: %s' % header for header in headers]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def send_error(self, writer, status, message):
+        self.errors += 1
+        await self.send(writer, status, 'text/plain; charset=utf-8', (message + '\n').encode('utf-8'))
+
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # headers are not used, but have to be consumed
+            while (await reader.readline()).strip():
+                pass
+
+            if len(request_line) != 3:
+                await self.send_error(writer, 400, 'Malformed request')
+                return
+            method, target, _ = request_line
+            url = urlsplit(target)
+            if 'GET' != method:
+                await self.send_error(writer, 405, 'Only GET requests are supported')
+            elif '/metrics' == url.path:
+                await self.send(writer, 200, 'application/json', json.dumps(self.metrics()).encode('utf-8'))
+            elif '/chart' == url.path:
+                try:
+                    job = parse_chart_query(url.query)
+                except ValueError as e:
+                    await self.send_error(writer, 400, str(e))
+                    return
+                async with self.slots:
+                    body = await asyncio.get_running_loop().run_in_executor(self.executor, render, *job)
+                render_ms = (time.perf_counter() - start) * 1000
+                await self.send(writer, 200, CONTENT_TYPES[job[4]], body, [('X-Render-Time-Ms', '%.1f' % render_ms)])
+                self.latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                await self.send_error(writer, 404, 'Unknown path %s, use /chart or /metrics' % url.path)
+        except Exception as e:
+            await self.send_error(writer, 500, '%s: %s' % (type(e).__name__, e))
+        finally:
+            self.in_flight -= 1
+            writer.close()
+
+
+def serve(host='127.0.0.1', port=8000, workers=None, index_path=None, background_dir=None, cache_dir=None,
+          cache_size=1024 * 1024 * 1024):
+
+    async def main():
+        server = ChartServer(workers, index_path=index_path, background_dir=background_dir, cache_dir=cache_dir,
+                             cache_size=cache_size)
+        try:
+            tcp_server = await server.start(host, port)
+            print('Serving charts on http://%s:%d/chart, metrics on http://%s:%d/metrics' % (host, port, host, port))
+            async with tcp_server:
+                await tcp_server.serve_forever()
+        finally:
+            server.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
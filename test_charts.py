@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from PIL import Image, features
+
+from charts import CHART_TYPES, MODES, create_chart
+
+DPI = 50
+SEED = 7
+
+
+def pixels(filename):
+    with Image.open(filename) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+@pytest.mark.parametrize('chart_type', CHART_TYPES)
+def test_parallel_sheets_match_sequential(chart_type, tmp_path):
+    chart = create_chart(chart_type)
+    chart.save('random', DPI, str(tmp_path / 'sequential.png'), verbose=False, seed=SEED)
+    chart.save('random', DPI, str(tmp_path / 'parallel.png'), verbose=False, seed=SEED, parallel=True)
+    for sheet in range(1, 4):
+        sequential = (tmp_path / ('sequential%d.png' % sheet)).read_bytes()
+        assert (tmp_path / ('parallel%d.png' % sheet)).read_bytes() == sequential
+
+
+@pytest.mark.parametrize('chart_type', CHART_TYPES)
+@pytest.mark.parametrize('mode', MODES)
+def test_streamed_chart_matches_composed(chart_type, mode, tmp_path):
+    chart = create_chart(chart_type)
+    chart.save('random', DPI, str(tmp_path / 'composed.png'), single=True, verbose=False, mode=mode, seed=SEED)
+    chart.save('random', DPI, str(tmp_path / 'streamed.png'), single=True, verbose=False, mode=mode, seed=SEED,
+               stream=True)
+    assert np.array_equal(pixels(tmp_path / 'streamed.png'), pixels(tmp_path / 'composed.png'))
+
+
+# tiles are deflated, Pillow reads them with libtiff only
+@pytest.mark.skipif(not features.check('libtiff'), reason='Pillow is built without libtiff')
+@pytest.mark.parametrize('chart_type', CHART_TYPES)
+@pytest.mark.parametrize('single', [False, True])
+def test_tiled_chart_matches_in_memory(chart_type, single, tmp_path):
+    chart = create_chart(chart_type)
+    chart.save('random', DPI, str(tmp_path / 'memory.png'), single=single, verbose=False, seed=SEED)
+    chart.save('random', DPI, str(tmp_path / 'tiled.tif'), single=single, verbose=False, seed=SEED, tile_size=64)
+    names = [''] if single else [str(sheet) for sheet in range(1, 4)]
+    for name in names:
+        assert np.array_equal(pixels(tmp_path / ('tiled%s.tif' % name)), pixels(tmp_path / ('memory%s.png' % name)))
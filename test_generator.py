@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from charts import CHART_TYPES, create_chart
+
+N_CHARTS = 4000
+
+
+def split_lines(symbols, line_lengths):
+    lines = []
+    start = 0
+    for n in line_lengths:
+        lines.append(np.asarray(symbols)[..., start:start + n])
+        start += n
+    return lines
+
+
+def line_statistics(lines):
+    # per line, the share of lines having a symbol twice, of lines having a symbol twice in a row, and the mean number
+    # of distinct symbols
+    statistics = []
+    for line in lines:
+        distinct = np.array([len(set(row)) for row in line.tolist()])
+        statistics.append(((distinct < line.shape[1]).mean(),
+                           (line[:, 1:] == line[:, :-1]).any(axis=1).mean(),
+                           distinct.mean()))
+    return np.array(statistics)
+
+
+def random_generator_lines(chart, rng):
+    # charts are drawn line by line, as by EyeChart.draw_symbols
+    rows = []
+    for _ in range(N_CHARTS):
+        generator = chart.symbol_generator('smart_random', rng=rng)
+        rows.append([symbol for n in chart.line_lengths() for symbol in generator.next_symbols(n)])
+    return split_lines(rows, chart.line_lengths())
+
+
+@pytest.mark.parametrize('chart_type', CHART_TYPES)
+def test_smart_random_lines_start_with_all_symbols(chart_type):
+    chart = create_chart(chart_type)
+    n_symbols = len(chart.symbol_renderers())
+    symbols = chart.sample_symbols('smart_random', N_CHARTS, rng=np.random.default_rng(0))
+    for line in split_lines(symbols, chart.line_lengths()):
+        head = np.sort(line[:, :n_symbols], axis=1)
+        assert (head[:, 1:] != head[:, :-1]).all()
+
+
+@pytest.mark.parametrize('chart_type', CHART_TYPES)
+def test_smart_random_lines_match_random_generator(chart_type):
+    chart = create_chart(chart_type)
+    expected = line_statistics(random_generator_lines(chart, np.random.default_rng(1)))
+    symbols = chart.sample_symbols('smart_random', N_CHARTS, rng=np.random.default_rng(2))
+    actual = line_statistics(split_lines(symbols, chart.line_lengths()))
+    assert np.allclose(actual, expected, atol=0.05)
@@ -0,0 +1,82 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from cache import OutputCache
+from charts import CHART_TYPES, GENERATORS, MODES, EyeChart, check_seed, create_chart
+from index import ChartIndex
+
+# options a job may set, the ones it does not set are taken from the command line
+JOB_OPTIONS = ('id', 'type', 'generator', 'dpi', 'filename', 'single', 'mode', 'stream', 'parallel', 'no_repeat',
+               'seed')
+
+# chart objects of the process by chart type, as the chart of a batch worker
+charts = {}
+
+
+def parse_job(job, defaults):
+
+    if not isinstance(job, dict):
+        raise ValueError('Job should be a JSON object')
+    unknown = sorted(set(job) - set(JOB_OPTIONS))
+    if unknown:
+        raise ValueError('Unknown job options %s' % ', '.join(unknown))
+    job = dict(defaults, **job)
+
+    if job['type'] not in CHART_TYPES:
+        raise ValueError('Unknown chart type %s' % job['type'])
+    if job['generator'] not in GENERATORS:
+        raise ValueError('Unknown generator %s' % job['generator'])
+    if not isinstance(job['dpi'], int) or job['dpi'] <= 0:
+        raise ValueError('Resolution should be a positive integer')
+    if job['mode'] not in MODES:
+        raise ValueError('Unknown image mode %s' % job['mode'])
+    if not isinstance(job['filename'], str) or not os.path.splitext(job['filename'])[1]:
+        raise ValueError('Filename should contain an extension')
+    check_seed(job['seed'])
+
+    return job
+
+
+def run_job(job, index=None, cache=None):
+
+    chart = charts.get(job['type'])
+    if chart is None:
+        chart = charts[job['type']] = create_chart(job['type'])
+
+    symbols = None
+    if job['no_repeat'] or index is not None:
+        symbols = chart.sample_symbols(job['generator'], 1, job['no_repeat'], index,
+                                       rng=np.random.default_rng(job['seed']))[0]
+    chart.save(job['generator'], job['dpi'], job['filename'], job['single'], verbose=False, mode=job['mode'],
+               stream=job['stream'], symbols=symbols, parallel=job['parallel'], seed=job['seed'], cache=cache)
+    return EyeChart.output_names(job['filename'], job['single'])
+
+
+def serve_jobs(input, output, defaults, index_path=None, background_dir=None, cache_dir=None,
+               cache_size=1024 * 1024 * 1024):
+
+    # a job per line, a result per job is written in the same order as soon as the job is done, a failed job does not
+    # stop the worker
+    EyeChart.background_cache.directory = background_dir
+    index = ChartIndex(index_path) if index_path else None
+    cache = OutputCache(cache_dir, cache_size) if cache_dir else None
+    for line in input:
+        if not line.strip():
+            continue
+        start = time.perf_counter()
+        result = {'id': None}
+        try:
+            job = json.loads(line)
+            if isinstance(job, dict):
+                result['id'] = job.get('id')
+            result['files'] = run_job(parse_job(job, defaults), index, cache)
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['seconds'] = time.perf_counter() - start
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+    if index is not None:
+        index.close()
@@ -0,0 +1,337 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+class StripWriter:
+
+    # number of image rows converted and compressed at once
+    BAND_HEIGHT = 256
+
+    def __init__(self, file, width, height, mode):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows = 0
+        # bands are aligned to the whole output, a band may span the end of one written image and the start of the next
+        self.band = []
+        self.band_rows = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and not self.closed:
+            self.close()
+        self.file.close()
+
+    def write(self, image):
+        assert image.mode == self.mode and image.width == self.width, 'Strip does not match the image'
+        assert self.rows + image.height <= self.height, 'Too many rows'
+        top = 0
+        while top < image.height:
+            rows = min(StripWriter.BAND_HEIGHT - self.band_rows, image.height - top)
+            self.band.append(image.crop((0, top, image.width, top + rows)).tobytes())
+            self.band_rows += rows
+            if self.band_rows == StripWriter.BAND_HEIGHT:
+                self.flush_band()
+            top += rows
+        self.rows += image.height
+
+    def flush_band(self):
+        if self.band_rows:
+            self.write_band(b''.join(self.band), self.band_rows)
+            self.band = []
+            self.band_rows = 0
+
+    def write_band(self, data, rows):
+        pass
+
+    def close(self):
+        assert self.rows == self.height, 'Image is incomplete, %d of %d rows written' % (self.rows, self.height)
+        self.flush_band()
+        self.closed = True
+
+
+class PngStripWriter(StripWriter):
+
+    # bit depth and color type
+    FORMATS = {'1': (1, 0), 'L': (8, 0), 'RGB': (8, 2)}
+
+    def __init__(self, file, width, height, mode, compress_level=6):
+        super().__init__(file, width, height, mode)
+        bit_depth, color_type = PngStripWriter.FORMATS[mode]
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+        self.compressor = zlib.compressobj(compress_level)
+
+    def write_chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(tag)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_band(self, data, rows):
+        # every scanline is prefixed by the filter type, 0 stands for no filtering
+        scanlines = np.frombuffer(data, dtype=np.uint8).reshape(rows, -1)
+        scanlines = np.hstack([np.zeros((rows, 1), dtype=np.uint8), scanlines])
+        compressed = self.compressor.compress(scanlines.tobytes())
+        if compressed:
+            self.write_chunk(b'IDAT', compressed)
+
+    def close(self):
+        super().close()
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+
+def write_tiff_header(file, bigtiff=False):
+    # the offset of the image file directory is patched when the directory is written
+    if bigtiff:
+        file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+    else:
+        file.write(b'II' + struct.pack('<HI', 42, 0))
+
+
+def write_tiff_directory(file, entries, bigtiff=False):
+    # entries are (tag, type, values) sorted by tag, values which do not fit into an entry are written before it
+    count_fmt, offset_fmt = ('<Q', '<Q') if bigtiff else ('<H', '<I')
+    offset_size = struct.calcsize(offset_fmt)
+
+    fields = []
+    for tag, field_type, values in entries:
+        data = struct.pack('<%d%s' % (len(values), TiffStripWriter.TYPES[field_type]), *values)
+        if len(data) <= offset_size:
+            value = data.ljust(offset_size, b'\0')
+        else:
+            if file.tell() % 2:
+                file.write(b'\0')
+            value = struct.pack(offset_fmt, file.tell())
+            file.write(data)
+        fields.append(struct.pack('<HH', tag, field_type) + struct.pack(offset_fmt, len(values)) + value)
+
+    if file.tell() % 2:
+        file.write(b'\0')
+    ifd_offset = file.tell()
+    file.write(struct.pack(count_fmt, len(fields)) + b''.join(fields) + struct.pack(offset_fmt, 0))
+    file.seek(8 if bigtiff else 4)
+    file.write(struct.pack(offset_fmt, ifd_offset))
+
+
+class TiffStripWriter(StripWriter):
+
+    # bits per sample, samples per pixel and photometric interpretation
+    FORMATS = {'1': (1, 1, 1), 'L': (8, 1, 1), 'RGB': (8, 3, 2)}
+
+    SHORT = 3
+    LONG = 4
+    LONG8 = 16
+    TYPES = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}
+
+    def __init__(self, file, width, height, mode, compress_level=6):
+        super().__init__(file, width, height, mode)
+        self.compress_level = compress_level
+        self.offsets = []
+        self.byte_counts = []
+        write_tiff_header(self.file)
+
+    def write_band(self, data, rows):
+        compressed = zlib.compress(data, self.compress_level)
+        self.offsets.append(self.file.tell())
+        self.byte_counts.append(len(compressed))
+        self.file.write(compressed)
+
+    def close(self):
+        super().close()
+        bits, samples, photometric = TiffStripWriter.FORMATS[self.mode]
+
+        entries = [(256, TiffStripWriter.LONG, [self.width]),
+                   (257, TiffStripWriter.LONG, [self.height]),
+                   (258, TiffStripWriter.SHORT, [bits] * samples),
+                   (259, TiffStripWriter.SHORT, [8]),                                     # deflate
+                   (262, TiffStripWriter.SHORT, [photometric]),
+                   (273, TiffStripWriter.LONG, self.offsets),
+                   (277, TiffStripWriter.SHORT, [samples]),
+                   (278, TiffStripWriter.LONG, [StripWriter.BAND_HEIGHT]),
+                   (279, TiffStripWriter.LONG, self.byte_counts)]
+        write_tiff_directory(self.file, entries)
+
+
+class TiledTiffWriter:
+
+    def __init__(self, file, width, height, mode, tile_size, compress_level=6):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.tile_size = tile_size
+        self.compress_level = compress_level
+        self.tiles = -(-width // tile_size) * -(-height // tile_size)
+        # offsets of a classic TIFF are 32 bit, so an image which may not fit into 4 GB is written as BigTIFF
+        self.bigtiff = TiledTiffWriter.max_size(width, height, mode, tile_size) >= 2**32
+        self.offsets = []
+        self.byte_counts = []
+        write_tiff_header(self.file, self.bigtiff)
+
+    @staticmethod
+    def max_size(width, height, mode, tile_size):
+        # deflated tiles are never longer than zlib compressBound of the tile, the directory takes a few hundred
+        # bytes and 16 bytes per tile at most
+        bits, samples, _ = TiffStripWriter.FORMATS[mode]
+        size = tile_size * tile_size * bits * samples // 8
+        bound = size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+        tiles = -(-width // tile_size) * -(-height // tile_size)
+        return 16 + tiles * (bound + 17) + 1024
+
+    def write_tile(self, data):
+        compressed = zlib.compress(data, self.compress_level)
+        self.offsets.append(self.file.tell())
+        self.byte_counts.append(len(compressed))
+        self.file.write(compressed)
+
+    def close(self):
+        assert len(self.offsets) == self.tiles, 'Image is incomplete, %d of %d tiles written' % (len(self.offsets),
+                                                                                                 self.tiles)
+        bits, samples, photometric = TiffStripWriter.FORMATS[self.mode]
+        offset_type = TiffStripWriter.LONG8 if self.bigtiff else TiffStripWriter.LONG
+
+        entries = [(256, TiffStripWriter.LONG, [self.width]),
+                   (257, TiffStripWriter.LONG, [self.height]),
+                   (258, TiffStripWriter.SHORT, [bits] * samples),
+                   (259, TiffStripWriter.SHORT, [8]),                                     # deflate
+                   (262, TiffStripWriter.SHORT, [photometric]),
+                   (277, TiffStripWriter.SHORT, [samples]),
+                   (322, TiffStripWriter.LONG, [self.tile_size]),
+                   (323, TiffStripWriter.LONG, [self.tile_size]),
+                   (324, offset_type, self.offsets),
+                   (325, offset_type, self.byte_counts)]
+        write_tiff_directory(self.file, entries, self.bigtiff)
+
+
+def open_strip_writer(filename, width, height, mode):
+    _, ext = os.path.splitext(filename)
+    if ext.lower() == '.png':
+        return PngStripWriter(open(filename, 'wb'), width, height, mode)
+    elif ext.lower() in ('.tif', '.tiff'):
+        return TiffStripWriter(open(filename, 'wb'), width, height, mode)
+    else:
+        raise NotImplementedError('Streaming output is supported for PNG and TIFF files only, not %s' % ext)
+
+
+# vector sheets are drawn in millimetres
+POINTS_PER_MM = 72 / 25.4
+
+# width of the lines drawn with ImageDraw.line in millimetres, about a pixel at 600 dpi
+LINE_WIDTH = 0.05
+
+
+def svg_color(color):
+    return '#%02x%02x%02x' % tuple(color[:3])
+
+
+def svg_path(commands):
+    return ' '.join(command[0] + ' '.join('%.3f %.3f' % point for point in command[1:]) for command in commands)
+
+
+def svg_text(text):
+    # same as xml.sax.saxutils.escape, which imports urllib and takes a large share of the start up time
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def write_svg(file, sheets, line_width=LINE_WIDTH):
+    # sheets are stacked top to bottom into a single document
+    width = sheets[0].width
+    height = sum(sheet.height for sheet in sheets)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<svg xmlns="http://www.w3.org/2000/svg" width="%gmm" height="%gmm" viewBox="0 0 %g %g">'
+             % (width, height, width, height),
+             '<rect width="%g" height="%g" fill="white"/>' % (width, height)]
+    top = 0
+    for sheet in sheets:
+        lines.append('<g transform="translate(0 %g)">' % top)
+        for item in sheet.items:
+            if 'path' == item[0]:
+                lines.append('<path d="%s" fill="%s"/>' % (svg_path(item[2]), svg_color(item[1])))
+            elif 'line' == item[0]:
+                lines.append('<polyline points="%s" fill="none" stroke="%s" stroke-width="%g"/>'
+                             % (' '.join('%.3f,%.3f' % point for point in item[2]), svg_color(item[1]), line_width))
+            elif 'text' == item[0]:
+                _, x, y, text, fontsize = item
+                lines.append('<text x="%.3f" y="%.3f" font-family="Arial, Helvetica, sans-serif" font-size="%g">'
+                             '%s</text>' % (x, y, fontsize, svg_text(text)))
+        lines.append('</g>')
+        top += sheet.height
+    lines.append('</svg>\n')
+    file.write('\n'.join(lines).encode('utf-8'))
+
+
+def pdf_color(color, operator):
+    return '%.3f %.3f %.3f %s' % (color[0] / 255, color[1] / 255, color[2] / 255, operator)
+
+
+def pdf_path(commands):
+    operators = {'M': 'm', 'L': 'l', 'C': 'c', 'Z': 'h'}
+    return '\n'.join(''.join('%.3f %.3f ' % point for point in command[1:]) + operators[command[0]]
+                     for command in commands)
+
+
+def pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def pdf_page(sheets, height, line_width):
+    # millimetres with y axis pointing down, the origin is the top left corner
+    content = ['%.5f 0 0 %.5f 0 %.3f cm' % (POINTS_PER_MM, -POINTS_PER_MM, height * POINTS_PER_MM),
+               '%g w' % line_width]
+    top = 0
+    for sheet in sheets:
+        content.append('q 1 0 0 1 0 %g cm' % top)
+        for item in sheet.items:
+            if 'path' == item[0]:
+                content += [pdf_color(item[1], 'rg'), pdf_path(item[2]), 'f']
+            elif 'line' == item[0]:
+                commands = [('M', item[2][0])] + [('L', point) for point in item[2][1:]]
+                content += [pdf_color(item[1], 'RG'), pdf_path(commands), 'S']
+            elif 'text' == item[0]:
+                _, x, y, text, fontsize = item
+                # the text matrix flips the glyphs back upright
+                content.append('0 0 0 rg BT /F1 %g Tf 1 0 0 -1 %.3f %.3f Tm (%s) Tj ET'
+                               % (fontsize, x, y, pdf_text(text)))
+        content.append('Q')
+        top += sheet.height
+    return zlib.compress('\n'.join(content).encode('latin-1'))
+
+
+def write_pdf(file, pages, line_width=LINE_WIDTH):
+    # every page is a list of sheets stacked top to bottom
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+    kids = []
+    for sheets in pages:
+        width = sheets[0].width
+        height = sum(sheet.height for sheet in sheets)
+        content = pdf_page(sheets, height, line_width)
+        objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream')
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.3f %.3f] /Contents %d 0 R '
+                       b'/Resources << /Font << /F1 3 0 R >> >> >>'
+                       % (width * POINTS_PER_MM, height * POINTS_PER_MM, len(objects)))
+        kids.append(len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    # object offsets are counted, since the file may not be seekable
+    position = 0
+    offsets = []
+    for chunk in [b'%PDF-1.4\n'] + [b'%d 0 obj\n' % number + obj + b'\nendobj\n'
+                                     for number, obj in enumerate(objects, 1)]:
+        offsets.append(position)
+        file.write(chunk)
+        position += len(chunk)
+    file.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets[1:]:
+        file.write(b'%010d 00000 n \n' % offset)
+    file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, position))